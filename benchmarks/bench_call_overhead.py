@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Per-call overhead of the sync facade against the async-native mode.
+
+Compares awaiting ``a_*`` coroutines on the caller's loop with calling the
+sync wrappers, which hop to the background loop thread, and with the old
+facade that built a new wrapper on every attribute access.
+
+    python -m benchmarks.bench_call_overhead [calls]
+"""
+import asyncio
+import functools
+import sys
+import time
+
+from sago.sago import BaseSago
+from sago.utils.functional import AsyncObject
+
+
+class BenchSago(BaseSago):
+
+    async def a_noop(self):
+        return None
+
+
+class UncachedSago(BenchSago):
+    """The facade as it was: every attribute access goes through Python."""
+
+    def __getattribute__(self, name):
+        try:
+            return super().__getattribute__(name)
+        except AttributeError as ex:
+            try:
+                a_func = super().__getattribute__('a_' + name)
+                return functools.update_wrapper(
+                    AsyncObject(a_func, self.core.loop), a_func)
+            except AttributeError:
+                raise ex
+
+
+def per_call(calls, fn):
+    started = time.perf_counter()
+    fn(calls)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def sync_calls(sago):
+    def run(calls):
+        for _ in range(calls):
+            sago.noop(nowait=False)
+    return run
+
+
+def attribute_reads(sago):
+    def run(calls):
+        for _ in range(calls):
+            sago.contacts
+    return run
+
+
+def async_calls(calls):
+    async def run(sago):
+        for _ in range(calls):
+            await sago.a_noop()
+
+    loop = asyncio.new_event_loop()
+    sago = BenchSago(loop=loop, auto_login=False)
+    try:
+        started = time.perf_counter()
+        loop.run_until_complete(run(sago))
+        return (time.perf_counter() - started) / calls * 1e6
+    finally:
+        loop.close()
+
+
+def main(calls=20000):
+    cached = BenchSago(auto_login=False)
+    uncached = UncachedSago(auto_login=False)
+
+    print('%d calls each, us per call' % calls)
+    print('async-native await        %8.2f' % async_calls(calls))
+    print('sync facade, cached       %8.2f' % per_call(
+        calls, sync_calls(cached)))
+    print('sync facade, uncached     %8.2f' % per_call(
+        calls, sync_calls(uncached)))
+    print('attribute read, cached    %8.3f' % per_call(
+        calls * 10, attribute_reads(cached)))
+    print('attribute read, uncached  %8.3f' % per_call(
+        calls * 10, attribute_reads(uncached)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
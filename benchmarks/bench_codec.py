@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Decode and encode time of webwxgetcontact-sized payloads: the old
+``json.loads(body.decode())`` path against sago.codec.
+
+    python -m benchmarks.bench_codec [contacts] [rounds]
+"""
+import json
+import sys
+import time
+
+from sago import codec
+
+
+def make_contact_list(count):
+    return {
+        'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+        'MemberCount': count,
+        'MemberList': [{
+            'Uin': 0,
+            'UserName': '@%032x' % i,
+            'NickName': '联系人%d 🌟' % i,
+            'HeadImgUrl': '/cgi-bin/mmwebwx-bin/webwxgeticon?seq=%d'
+                          '&username=@%032x&skey=@crypt_0' % (i, i),
+            'ContactFlag': 3,
+            'MemberCount': 0,
+            'MemberList': [],
+            'RemarkName': '备注%d' % i,
+            'HideInputBarFlag': 0,
+            'Sex': i % 3,
+            'Signature': '签名 signature %d' % i,
+            'VerifyFlag': 0,
+            'OwnerUin': 0,
+            'PYInitial': 'LXR%d' % i,
+            'PYQuanPin': 'lianxiren%d' % i,
+            'RemarkPYInitial': 'BZ%d' % i,
+            'RemarkPYQuanPin': 'beizhu%d' % i,
+            'StarFriend': 0,
+            'AppAccountFlag': 0,
+            'Statues': 0,
+            'AttrStatus': 33656871,
+            'Province': '广东',
+            'City': '深圳',
+            'Alias': '',
+            'SnsFlag': 17,
+            'UniFriend': 0,
+            'DisplayName': '',
+            'ChatRoomId': 0,
+            'KeyWord': '',
+            'EncryChatRoomId': '',
+            'IsOwner': 0,
+        } for i in range(count)],
+        'Seq': 0,
+    }
+
+
+def best_of(rounds, fn, *args):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(contacts=20000, rounds=5):
+    payload = make_contact_list(contacts)
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    print('%d contacts, %.1f MiB body, codec backend: %s' % (
+        contacts, len(body) / 2 ** 20, codec.BACKEND))
+
+    old = best_of(rounds, lambda b: json.loads(b.decode('utf-8')), body)
+    new = best_of(rounds, codec.loads, body)
+    print('decode  str path %7.1f ms   codec %7.1f ms   %.1fx' % (
+        old * 1e3, new * 1e3, old / new))
+
+    old = best_of(rounds, lambda p: json.dumps(p).encode('utf-8'), payload)
+    new = best_of(rounds, codec.dumps, payload)
+    print('encode  str path %7.1f ms   codec %7.1f ms   %.1fx' % (
+        old * 1e3, new * 1e3, old / new))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Lookup time of Contacts.find over a large synthetic contact list.
+
+    python -m benchmarks.bench_contact_search [contacts]
+"""
+import random
+import sys
+import time
+
+from sago.models.contacts import Contacts, ContactGroup
+from sago.models.user import ChatRoom, create_user, Friend, MP
+
+SURNAMES = (('王', 'wang'), ('李', 'li'), ('张', 'zhang'), ('刘', 'liu'),
+            ('陈', 'chen'), ('杨', 'yang'), ('黄', 'huang'), ('赵', 'zhao'))
+GIVEN = (('伟', 'wei'), ('芳', 'fang'), ('娜', 'na'), ('敏', 'min'),
+         ('静', 'jing'), ('丽', 'li'), ('强', 'qiang'), ('磊', 'lei'),
+         ('军', 'jun'), ('洋', 'yang'), ('勇', 'yong'), ('艳', 'yan'))
+
+
+def make_contacts(count, seed=0):
+    rnd = random.Random(seed)
+    for i in range(count):
+        name = [rnd.choice(SURNAMES)] + rnd.choices(GIVEN, k=rnd.randint(1, 2))
+        remark = rnd.random() < 0.3
+        yield {
+            'UserName': '@%032x' % rnd.getrandbits(128),
+            'NickName': ''.join(c for c, _ in name) + str(i),
+            'RemarkName': 'remark %d' % i if remark else '',
+            'PYInitial': ''.join(p[0] for _, p in name).upper() + str(i),
+            'PYQuanPin': ''.join(p for _, p in name) + str(i),
+            'RemarkPYInitial': 'R%d' % i if remark else '',
+            'RemarkPYQuanPin': 'remark%d' % i if remark else '',
+        }
+
+
+def timed(fn, rounds=1000):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - started) / rounds * 1e3, len(result)
+
+
+def main(count=50000):
+    contacts = Contacts()
+    contacts.add('friends', ContactGroup(Friend))
+    contacts.add('mps', ContactGroup(MP))
+    contacts.add('chatrooms', ContactGroup(ChatRoom))
+
+    users = [create_user(data, 'key') for data in make_contacts(count)]
+    started = time.perf_counter()
+    for user in users:
+        contacts.add_user(user)
+    print('%d contacts added in %.2f s' % (
+        count, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    contacts.find('x')
+    print('first lookup (sorts names) %.1f ms' % (
+        (time.perf_counter() - started) * 1e3))
+
+    for name, query in (('exact nickname', users[123].nickname),
+                        ('nickname prefix', users[123].nickname[:2]),
+                        ('remark name', 'remark 4'),
+                        ('pinyin initials', 'wl'),
+                        ('full pinyin', 'zhangwei'),
+                        ('no match', 'qqqq')):
+        ms, hits = timed(lambda: contacts.find(query))
+        print('%-16s %8.4f ms (%d hits)' % (name, ms, hits))
+
+    contacts.add_user(create_user(dict(next(make_contacts(1, seed=1)),
+                                       NickName='新朋友'), 'key'))
+    started = time.perf_counter()
+    contacts.find('新')
+    print('lookup after one update %.1f ms' % (
+        (time.perf_counter() - started) * 1e3))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Write throughput and query latency of sago.history.MessageHistory.
+
+    python -m benchmarks.bench_history [messages] [chats]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sago.history import MessageHistory
+from sago.models.message import TextMessage
+
+
+def make_messages(count, chats, seed=0):
+    rnd = random.Random(seed)
+    rooms = ['@@%064x' % rnd.getrandbits(256) for _ in range(chats)]
+    members = ['@%032x' % rnd.getrandbits(128) for _ in range(chats * 20)]
+    started = int(time.time()) - count
+    return [TextMessage({
+        'MsgId': str(10 ** 18 + i),
+        'MsgType': 1,
+        'FromUserName': rnd.choice(rooms),
+        'ToUserName': '@self',
+        'Content': '%s:<br/>message %d' % (rnd.choice(members), i),
+        'CreateTime': started + i,
+    }) for i in range(count)], rooms
+
+
+def timed(fn, rounds=200):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1e3
+
+
+def main(count=200000, chats=500):
+    messages, rooms = make_messages(count, chats)
+    with tempfile.TemporaryDirectory() as tmp:
+        history = MessageHistory(os.path.join(tmp, 'history.db'))
+
+        started = time.perf_counter()
+        for i in range(0, count, 100):
+            history.append(messages[i:i + 100], '@self')
+        queued = time.perf_counter() - started
+        history.flush().result()
+        elapsed = time.perf_counter() - started
+
+        print('%d messages in %d chats' % (count, chats))
+        print('append (loop side)   %8.2f us/msg' % (queued / count * 1e6))
+        print('write throughput     %8.0f msg/s in %d batches' % (
+            count / elapsed, history.stats['batches']))
+
+        started = time.perf_counter()
+        history.append(messages[:10000], '@self')
+        history.flush().result()
+        print('10000 duplicates     %8.0f msg/s, %d ignored' % (
+            10000 / (time.perf_counter() - started),
+            history.stats['duplicates']))
+
+        room = rooms[0]
+        print('latest 50 of a chat  %8.3f ms' % timed(
+            lambda: history.query(chat=room, limit=50)))
+        _, cursor = history.query(chat=room, limit=50)
+        print('next page            %8.3f ms' % timed(
+            lambda: history.query(chat=room, limit=50, before=cursor)))
+        sender = messages[0].content.partition(':')[0]
+        print('by sender            %8.3f ms' % timed(
+            lambda: history.query(sender=sender, limit=50)))
+        print('time range           %8.3f ms' % timed(
+            lambda: history.query(since=messages[1000].create_time,
+                                  until=messages[2000].create_time)))
+        print('get by MsgId         %8.3f ms' % timed(
+            lambda: history.get(messages[12345].msg_id)))
+        history.close()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
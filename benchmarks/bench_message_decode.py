@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Messages decoded per second by MessageFactory on synthetic AddMsgList
+batches.
+
+    python -m benchmarks.bench_message_decode [messages] [rounds]
+"""
+import random
+import sys
+import time
+
+from sago.models.contacts import Contacts, ContactGroup
+from sago.models.message import MessageFactory
+from sago.models.user import ChatRoom, create_user, Friend, MP
+
+# Fields of a webwxsync AddMsgList entry besides the ones set below.
+PADDING_FIELDS = (
+    'Status', 'ImgStatus', 'VoiceLength', 'PlayLength', 'FileSize',
+    'MediaId', 'ForwardFlag', 'StatusNotifyCode', 'StatusNotifyUserName',
+    'HasProductId', 'Ticket', 'ImgHeight', 'ImgWidth', 'SubMsgType',
+    'NewMsgId', 'OriContent', 'EncryFileName', 'AppInfo', 'RecommendInfo')
+
+MSG_TYPES = (1, 1, 1, 1, 3, 47, 49, 10000)
+
+APP_CONTENT = (
+    '&lt;msg&gt;&lt;appmsg appid="" sdkver="0"&gt;&lt;title&gt;t&lt;/title&gt;'
+    '&lt;url&gt;https://example.com/&lt;/url&gt;&lt;/appmsg&gt;&lt;/msg&gt;')
+
+
+def make_contacts(friends=2000, chatrooms=100):
+    contacts = Contacts()
+    contacts.add('friends', ContactGroup(Friend))
+    contacts.add('mps', ContactGroup(MP))
+    contacts.add('chatrooms', ContactGroup(ChatRoom))
+
+    uids = []
+    for i in range(friends):
+        uids.append(contacts.add_user(create_user(
+            {'UserName': '@%032x' % i, 'NickName': 'f%d' % i}, 'key')).uid)
+    for i in range(chatrooms):
+        uids.append(contacts.add_user(create_user(
+            {'UserName': '@@%064x' % i, 'NickName': 'r%d' % i}, 'key')).uid)
+
+    return contacts, uids
+
+
+def make_batch(size, uids, seed=0):
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(size):
+        msg_type = rnd.choice(MSG_TYPES)
+        msg_data = dict.fromkeys(PADDING_FIELDS, 0)
+        msg_data.update({
+            'MsgId': str(10 ** 18 + i),
+            'MsgType': msg_type,
+            'FromUserName': rnd.choice(uids),
+            'ToUserName': uids[0],
+            'Content': APP_CONTENT if msg_type == 49 else 'hello %d' % i,
+            'CreateTime': 1500000000 + i,
+            'AppMsgType': 5,
+            'FileName': 'title',
+            'Url': '',
+        })
+        batch.append(msg_data)
+
+    return batch
+
+
+def bench(label, fn, batch, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(batch)
+    elapsed = time.perf_counter() - started
+    print('%-28s %10.0f msg/s' % (label, len(batch) * rounds / elapsed))
+
+
+def main(messages=10000, rounds=20):
+    contacts, uids = make_contacts()
+    factory = MessageFactory(contacts, 'key')
+    batch = make_batch(messages, uids)
+
+    bench('decode only', factory.build_all, batch, rounds)
+    bench('decode + content', lambda b: [
+        m.content for m in factory.build_all(b)], batch, rounds)
+    bench('decode + content + urls', lambda b: [
+        (m.content, getattr(m, 'url', None)) for m in factory.build_all(b)],
+        batch, rounds)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Event loop stalls caused by a CPU-heavy handler, run inline and on the
+offload process pool.
+
+A ticker coroutine stands in for the sync long-poll and records how late
+it wakes up while the dispatcher works through a burst of messages.
+
+    python -m benchmarks.bench_offload [messages] [handler_ms]
+"""
+import asyncio
+import hashlib
+import sys
+import time
+
+from sago.dispatcher import Dispatcher
+from sago.models.message import TextMessage
+from sago.offload import Offloader, shutdown_executors
+
+
+def heavy_handler(message):
+    # The CPU time to burn comes with the message: pool workers import this
+    # module afresh and do not see the parent's settings.
+    ms = int(message.content.rsplit(' ', 1)[1])
+    deadline = time.process_time() + ms / 1000
+    digest = message.content.encode('utf-8')
+    while time.process_time() < deadline:
+        digest = hashlib.sha256(digest).digest()
+    return digest
+
+
+async def ticker(lags, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(messages, offload):
+    dispatcher = Dispatcher(
+        maxsize=len(messages), workers=8,
+        offloader=Offloader(max_pending=len(messages)))
+    dispatcher.register(offload=offload)(heavy_handler)
+    dispatcher.start()
+    if offload:
+        # Start the workers before timing.
+        await dispatcher.offloader.submit(heavy_handler, messages[0])
+
+    lags = []
+    tick = asyncio.get_event_loop().create_task(ticker(lags))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await dispatcher.feed(messages)
+    await dispatcher.join()
+    elapsed = time.perf_counter() - started
+    # Let the ticker wake up once more to record the last stall.
+    await asyncio.sleep(0.05)
+    tick.cancel()
+    dispatcher.stop()
+    dispatcher.offloader.shutdown()
+    shutdown_executors()
+    return elapsed, max(lags), dispatcher.stats
+
+
+def main(count=200, handler_ms=20):
+    messages = [TextMessage({
+        'MsgId': str(i), 'MsgType': 1, 'FromUserName': '@@room',
+        'ToUserName': '@self', 'Content': 'message %d %d' % (i, handler_ms),
+    }) for i in range(count)]
+
+    print('%d messages, %d ms of CPU each' % (count, handler_ms))
+    for name, offload in (('inline', False), ('offloaded', True)):
+        elapsed, max_lag, stats = asyncio.run(run(messages, offload))
+        print('%-10s %6.2f s total, %7.1f msg/s, worst loop stall %7.1f ms'
+              ' (%d handled)' % (name, elapsed, count / elapsed,
+                                 max_lag * 1e3, stats['handled']))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
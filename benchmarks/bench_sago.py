@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of BaseSago against the local stub server.
+
+Reports login-to-ready time, contact ingest rate, sync throughput and the
+CPU time spent per message. The stub runs in a child process so its own
+work is not counted.
+
+    python -m benchmarks.bench_sago --contacts 50000 --chatrooms 500 \\
+        --msg-rate 2000 --duration 10
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from sago.core import Core
+from sago.sago import BaseSago
+
+from .stub_server import StubWeChatServer
+
+
+def run_stub(conn, options):
+    server = StubWeChatServer(**options)
+    loop = asyncio.new_event_loop()
+    base_url = loop.run_until_complete(server.start())
+    conn.send(server.urls(base_url))
+    loop.run_forever()
+
+
+class BenchSago(BaseSago):
+
+    async def a_show_login_qrcode(self, uuid):
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--contacts', type=int, default=50000)
+    parser.add_argument('--chatrooms', type=int, default=500)
+    parser.add_argument('--members-per-room', type=int, default=200)
+    parser.add_argument('--msg-rate', type=float, default=2000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--lazy-contacts', action='store_true',
+                        help='resolve contacts on demand instead of at login')
+    args = parser.parse_args()
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    stub = multiprocessing.Process(target=run_stub, daemon=True, args=(
+        child_conn, {
+            'contacts': args.contacts,
+            'chatrooms': args.chatrooms,
+            'members_per_room': args.members_per_room,
+            'msg_rate': args.msg_rate,
+        }))
+    stub.start()
+    urls = parent_conn.recv()
+
+    try:
+        started_at = time.perf_counter()
+        sago = BenchSago(core=Core(urls=urls),
+                         lazy_contacts=args.lazy_contacts)
+        sago.f.result()
+        ready_after = time.perf_counter() - started_at
+
+        stats = sago.contact_stats
+        print('login to ready      %8.2f s' % ready_after)
+        if stats:
+            print('contacts            %8d (%d chatroom members fetched)' % (
+                stats['count'], sum(len(r.members)
+                                    for r in sago.contacts.chatrooms.members)))
+            print('contact ingest      %8.0f contacts/s, first after %.3f s'
+                  % (stats['count'] / stats['elapsed'],
+                     stats['time_to_first_contact']))
+
+        handled = [0]
+
+        @sago.on()
+        def count(message):
+            handled[0] += 1
+
+        cpu_started = time.process_time()
+        sync_started = time.perf_counter()
+        heart_beat = sago.heart_beat()
+        time.sleep(args.duration)
+        heart_beat.cancel()
+        resolved = sago.contacts.count
+        batches = sago._resolver.stats['batches'] if sago._resolver else 0
+        sago.logout()
+        sago.run_async(sago.core.close, nowait=False)
+        elapsed = time.perf_counter() - sync_started
+        cpu = time.process_time() - cpu_started
+
+        print('sync throughput     %8.0f msg/s (%d messages, %d syncs)' % (
+            handled[0] / elapsed, handled[0], sago.sync_stats.syncs))
+        if args.lazy_contacts:
+            print('contacts resolved   %8d in %d batches' % (
+                resolved, batches))
+        if handled[0]:
+            print('per-message cost    %8.1f us CPU' % (
+                cpu / handled[0] * 1e6))
+    finally:
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Index build rate, size and query latency of sago.search.SearchIndex on
+synthetic, mostly Chinese chat history.
+
+    python -m benchmarks.bench_search [messages] [chats]
+"""
+import random
+import sys
+import time
+
+from sago.search import SearchIndex
+
+COMMON = ('的一是不了人我在有他这中大来上个国到说们为子和你地出会也时要就可以'
+          '对生能而那得于着下自之年过发后作里用道行所然家种事成方多经么去法学'
+          '如都同现当没动面起看定天分还进好小部其些主样理心她本前开但因只从想')
+RARE = '鑫淼犇骉焱垚赟龘麤羴'
+WORDS = ('ok', 'hello', 'meeting', 'python', 'deploy', 'lunch', 'thanks')
+
+
+def make_records(count, chats, seed=0):
+    rnd = random.Random(seed)
+    rooms = ['@@%064x' % rnd.getrandbits(256) for _ in range(chats)]
+    members = ['@%032x' % rnd.getrandbits(128) for _ in range(chats * 20)]
+    weights = [1.0 / (i + 1) for i in range(len(COMMON))]
+    started = int(time.time()) - count
+    for i in range(count):
+        text = ''.join(rnd.choices(COMMON, weights, k=rnd.randint(4, 30)))
+        if rnd.random() < 0.001:
+            text += rnd.choice(RARE) + rnd.choice(RARE)
+        if rnd.random() < 0.2:
+            text += ' ' + rnd.choice(WORDS)
+        yield {
+            'id': i + 1,
+            'msg_type': 1,
+            'chat': rnd.choice(rooms),
+            'sender': rnd.choice(members),
+            'create_time': started + i,
+            'content': text,
+        }
+
+
+def timed(fn, rounds=20):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hits = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1e3, len(hits)
+
+
+def main(count=500000, chats=500):
+    records = list(make_records(count, chats))
+    # Phrase hits are checked against the text, as MessageHistory does.
+    index = SearchIndex(
+        texts=lambda ids: {i: records[i - 1]['content'] for i in ids})
+    started = time.perf_counter()
+    index.add_all(records)
+    elapsed = time.perf_counter() - started
+    stats = index.stats()
+    print('%d messages, %d terms, %.1f MiB of postings' % (
+        stats['documents'], stats['terms'], stats['posting_bytes'] / 2 ** 20))
+    print('index build         %8.0f msg/s' % (count / elapsed))
+
+    chat = records[0]['chat']
+    queries = [
+        ('one character', COMMON[30], {}),
+        ('rare bigram', RARE[0] + RARE[1], {}),
+        ('common bigram', COMMON[0] + COMMON[1], {}),
+        ('common, one chat', COMMON[0] + COMMON[1], {'chat': chat}),
+        ('4-char phrase', COMMON[:4], {}),
+        ('word + bigram', 'python ' + COMMON[2:4], {}),
+        ('last hour', COMMON[5:7], {'since': records[-3600]['create_time']}),
+    ]
+    for name, query, filters in queries:
+        ms, hits = timed(lambda: index.search(query, **filters))
+        print('%-18s  %8.2f ms (%d hits)' % (name, ms, hits))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Message throughput of many accounts run by the Supervisor against the
+local stub server, with a worker killed halfway to exercise restarts.
+
+    python -m benchmarks.bench_supervisor --accounts 16 --workers 4 \\
+        --msg-rate 500 --duration 10
+"""
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from sago.supervisor import Supervisor
+
+from .bench_sago import BenchSago, run_stub
+
+
+class CountingSupervisor(Supervisor):
+
+    RESTART_DELAY = 0.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = collections.Counter()
+
+    def message_received(self, account, message):
+        self.received[account] += 1
+
+    def account_status_changed(self, account, status):
+        pass
+
+
+async def run(args, urls, session_dir):
+    supervisor = CountingSupervisor(
+        BenchSago, ['account-%d' % i for i in range(args.accounts)],
+        args.workers, session_dir, {'lazy_contacts': True}, {'urls': urls})
+    await supervisor.start()
+
+    started_at = time.perf_counter()
+    while (sum(s == 'online' for s in supervisor.statuses.values()) <
+           args.accounts):
+        await asyncio.sleep(0.05)
+    print('%d accounts online on %d workers after %.2f s' % (
+        args.accounts, len(supervisor.workers),
+        time.perf_counter() - started_at))
+
+    supervisor.received.clear()
+    started_at = time.perf_counter()
+    await asyncio.sleep(args.duration / 2)
+    victim = supervisor.workers[0]
+    os.kill(victim.process.pid, signal.SIGKILL)
+    await asyncio.sleep(args.duration / 2)
+    elapsed = time.perf_counter() - started_at
+
+    reply = await supervisor.send_text('account-0', 'filehelper', 'ping')
+    stats = await supervisor.stats()
+    await supervisor.stop()
+
+    total = sum(supervisor.received.values())
+    print('received            %8.0f msg/s (%d messages)' % (
+        total / elapsed, total))
+    print('worker restarts     %8d, %d of %d accounts back online' % (
+        sum(stats['restarts'].values()),
+        sum(s == 'online' for s in stats['statuses'].values()),
+        args.accounts))
+    print('send via worker     %s' % reply)
+    print('fleet totals        %s' % stats['total'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--contacts', type=int, default=1000)
+    parser.add_argument('--msg-rate', type=float, default=500)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    stub = multiprocessing.Process(target=run_stub, daemon=True, args=(
+        child_conn, {
+            'contacts': args.contacts,
+            'chatrooms': 50,
+            'members_per_room': 20,
+            'msg_rate': args.msg_rate,
+        }))
+    stub.start()
+    urls = parent_conn.recv()
+
+    try:
+        with tempfile.TemporaryDirectory() as session_dir:
+            asyncio.run(run(args, urls, session_dir))
+    finally:
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
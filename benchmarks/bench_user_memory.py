@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Compare the memory held by chatroom members before and after slotted,
+shared user models, on a synthetic account.
+
+    python -m benchmarks.bench_user_memory [members] [chatrooms]
+"""
+import gc
+import json
+import random
+import sys
+import tracemalloc
+
+from sago.models.contacts import Contacts, ContactGroup
+from sago.models.user import ChatRoom, create_user, Friend, MP
+
+
+class LegacyUser:
+    """The dict-backed layout models used before ``__slots__``."""
+
+    def __init__(self, initial_data):
+        self._uid = initial_data['UserName']
+        self._nickname = initial_data.get('NickName', '')
+        self._avatar_url = ''.join((
+            'https://wx.qq.com', initial_data.get('HeadImgUrl', ''),
+            initial_data.get('skey', '')))
+        self._city = initial_data.get('City', '')
+        self._gender = initial_data.get('Sex', 0)
+        self.signature = initial_data.get('Signature', '')
+        self.contact_group = None
+
+
+def make_account(members, chatrooms, seed=0):
+    rnd = random.Random(seed)
+    people = [{
+        'UserName': '@%032x' % rnd.getrandbits(128),
+        'NickName': 'member-%d' % i,
+        'HeadImgUrl': '/cgi-bin/mmwebwx-bin/webwxgeticon?seq=%d' % i,
+        'City': 'city',
+        'Sex': i % 3,
+    } for i in range(members)]
+
+    rooms = []
+    for i in range(chatrooms):
+        size = min(len(people), rnd.randint(50, 500))
+        rooms.append({
+            'UserName': '@@%064x' % rnd.getrandbits(256),
+            'NickName': 'room-%d' % i,
+            # Round-trip through json as the server payload does, so every
+            # room carries its own copies of the same member's strings.
+            'MemberList': json.loads(json.dumps(rnd.sample(people, size))),
+        })
+
+    return rooms
+
+
+def build_legacy(rooms):
+    return [[LegacyUser(dict(m, skey='key')) for m in room['MemberList']]
+            for room in rooms]
+
+
+def build_compact(rooms):
+    contacts = Contacts()
+    contacts.add('friends', ContactGroup(Friend))
+    contacts.add('mps', ContactGroup(MP))
+    contacts.add('chatrooms', ContactGroup(ChatRoom))
+
+    for room_info in rooms:
+        room = contacts.add_user(create_user(dict(room_info), 'key'))
+        for member_data in room_info['MemberList']:
+            room.add(contacts.get_or_create_member(dict(member_data), 'key'))
+
+    return contacts
+
+
+def measure(build, rooms):
+    gc.collect()
+    tracemalloc.start()
+    ret = build(rooms)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del ret
+    return current
+
+
+def main(members=100000, chatrooms=500):
+    rooms = make_account(members, chatrooms)
+    memberships = sum(len(r['MemberList']) for r in rooms)
+    print('%d members, %d chatrooms, %d memberships' % (
+        members, chatrooms, memberships))
+
+    legacy = measure(build_legacy, rooms)
+    compact = measure(build_compact, rooms)
+    print('legacy : %8.1f MiB' % (legacy / 2 ** 20))
+    print('compact: %8.1f MiB (%.1f%%)' % (
+        compact / 2 ** 20, 100.0 * compact / legacy))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the WeChat web endpoints sago talks to.
+
+It serves one account with a synthetic contact list and generates incoming
+messages at a fixed rate, so login, contact ingest and sync can be measured
+without touching wx.qq.com.
+
+    python -m benchmarks.stub_server --contacts 50000 --chatrooms 500
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+PREFIX = '/cgi-bin/mmwebwx-bin/'
+
+
+class StubWeChatServer:
+
+    def __init__(self, contacts=50000, chatrooms=500, members_per_room=200,
+                 msg_rate=2000, page_size=5000, max_batch=1000, poll_hold=1.0,
+                 seed=0):
+        self.contacts = contacts
+        self.chatrooms = chatrooms
+        self.members_per_room = members_per_room
+        self.msg_rate = msg_rate
+        self.page_size = page_size
+        self.max_batch = max_batch
+        self.poll_hold = poll_hold
+
+        self._rnd = random.Random(seed)
+        self._friends = ['@%032x' % self._rnd.getrandbits(128)
+                         for _ in range(contacts)]
+        self._rooms = ['@@%064x' % self._rnd.getrandbits(256)
+                       for _ in range(chatrooms)]
+        self._self_uid = '@%032x' % self._rnd.getrandbits(128)
+        self._sync_seq = 1
+        self._msg_id = 10 ** 18
+        # Every login gets its own sid and its own stream of messages.
+        self._sessions = {}
+        self._sids = 0
+        self._runner = None
+
+        self.stats = {'messages': 0, 'syncs': 0, 'polls': 0, 'sent': 0}
+
+    @property
+    def sync_key(self):
+        return {'Count': 1, 'List': [{'Key': 1, 'Val': self._sync_seq}]}
+
+    def urls(self, base_url):
+        url = base_url + PREFIX
+        return {
+            'request_uuid': base_url + '/jslogin',
+            'login_page': url + 'webwxnewloginpage',
+            'listen_qrcode_scanned': url + 'login',
+            'init_client': url + 'webwxinit',
+            'request_all_contact': url + 'webwxgetcontact',
+            'batch_get_contact': url + 'webwxbatchgetcontact',
+            'sync_check': url + 'synccheck',
+            'sync_data': url + 'webwxsync',
+            'send_msg': url + 'webwxsendmsg',
+        }
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 2 ** 20)
+        router = app.router
+        router.add_get('/jslogin', self.jslogin)
+        router.add_get(PREFIX + 'login', self.login)
+        router.add_get(PREFIX + 'webwxnewloginpage', self.login_page)
+        router.add_post(PREFIX + 'webwxinit', self.init)
+        router.add_post(PREFIX + 'webwxgetcontact', self.get_contact)
+        router.add_post(PREFIX + 'webwxbatchgetcontact', self.batch_get_contact)
+        router.add_get(PREFIX + 'synccheck', self.sync_check)
+        router.add_post(PREFIX + 'webwxsync', self.sync)
+        router.add_post(PREFIX + 'webwxsendmsg', self.send_msg)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return 'http://%s:%d' % (host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # login
+
+    async def jslogin(self, request):
+        return web.Response(text='window.QRLogin.code = 200; '
+                                 'window.QRLogin.uuid = "stub-uuid==";')
+
+    async def login(self, request):
+        url = '%s://%s%swebwxnewloginpage?ticket=stub&uuid=%s&scan=1' % (
+            request.scheme, request.host, PREFIX, request.query['uuid'])
+        return web.Response(
+            text='window.code=200;\nwindow.redirect_uri="%s";' % url)
+
+    async def login_page(self, request):
+        self._sids += 1
+        return web.Response(
+            content_type='text/xml',
+            text='<error><ret>0</ret><message></message>'
+                 '<skey>@crypt_stub</skey><wxsid>stubsid%d</wxsid>'
+                 % self._sids +
+                 '<wxuin>10000</wxuin><pass_ticket>stubticket</pass_ticket>'
+                 '<isgrayscale>1</isgrayscale></error>')
+
+    async def init(self, request):
+        data = await request.json()
+        self._sessions[data['BaseRequest']['Sid']] = time.monotonic()
+        return json_response({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'User': {'UserName': self._self_uid, 'NickName': 'stub'},
+            'SyncKey': self.sync_key,
+            'ContactList': [],
+        })
+
+    # contacts
+
+    def _contact(self, uid, i):
+        return {
+            'UserName': uid,
+            'NickName': 'contact-%d' % i,
+            'RemarkName': '',
+            'HeadImgUrl': PREFIX + 'webwxgeticon?seq=%d&username=%s' % (
+                i, uid),
+            'Sex': i % 3,
+            'Signature': '',
+            'VerifyFlag': 0,
+            'City': 'City',
+            'Province': 'Province',
+            'PYInitial': 'CONTACT%d' % i,
+            'PYQuanPin': 'contact%d' % i,
+            'ContactFlag': 3,
+            'MemberCount': 0,
+            'MemberList': [],
+        }
+
+    async def get_contact(self, request):
+        seq = int(request.query.get('seq', 0))
+        everyone = self._friends + self._rooms
+        page = everyone[seq:seq + self.page_size]
+        next_seq = seq + len(page) if seq + len(page) < len(everyone) else 0
+        return json_response({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'MemberCount': len(page),
+            'MemberList': [self._contact(uid, seq + i)
+                           for i, uid in enumerate(page)],
+            'Seq': next_seq,
+        })
+
+    async def batch_get_contact(self, request):
+        data = await request.json()
+        contact_list = []
+        for item in data['List']:
+            uid = item['UserName']
+            info = self._contact(uid, hash(uid) % 100000)
+            if uid.startswith('@@'):
+                rnd = random.Random(uid)
+                info['MemberList'] = [{
+                    'UserName': member,
+                    'NickName': 'contact',
+                    'DisplayName': '',
+                    'AttrStatus': 0,
+                } for member in rnd.sample(
+                    self._friends, min(self.members_per_room,
+                                       len(self._friends)))]
+                info['MemberCount'] = len(info['MemberList'])
+            contact_list.append(info)
+
+        return json_response({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'Count': len(contact_list),
+            'ContactList': contact_list,
+        })
+
+    # sync
+
+    def _pending(self, sid):
+        since = self._sessions.get(sid)
+        if since is None:
+            return 0
+        pending = (time.monotonic() - since) * self.msg_rate
+        return min(int(pending), self.max_batch)
+
+    async def sync_check(self, request):
+        self.stats['polls'] += 1
+        sid = request.query.get('sid')
+        deadline = time.monotonic() + self.poll_hold
+        while not self._pending(sid) and time.monotonic() < deadline:
+            await asyncio.sleep(min(0.01, 1.0 / self.msg_rate))
+
+        selector = '2' if self._pending(sid) else '0'
+        return web.Response(
+            text='window.synccheck={retcode:"0",selector:"%s"}' % selector)
+
+    def _message(self):
+        self._msg_id += 1
+        rnd = self._rnd
+        from_user = rnd.choice(self._rooms or self._friends)
+        return {
+            'MsgId': str(self._msg_id),
+            'FromUserName': from_user,
+            'ToUserName': self._self_uid,
+            'MsgType': 1,
+            'Content': '%s:<br/>message %d' % (
+                rnd.choice(self._friends), self._msg_id),
+            'Status': 3,
+            'ImgStatus': 1,
+            'CreateTime': int(time.time()),
+            'VoiceLength': 0,
+            'PlayLength': 0,
+            'FileName': '',
+            'FileSize': '',
+            'MediaId': '',
+            'Url': '',
+            'AppMsgType': 0,
+            'StatusNotifyCode': 0,
+            'StatusNotifyUserName': '',
+            'HasProductId': 0,
+            'Ticket': '',
+            'ImgHeight': 0,
+            'ImgWidth': 0,
+            'SubMsgType': 0,
+            'NewMsgId': self._msg_id,
+            'OriContent': '',
+        }
+
+    async def sync(self, request):
+        sid = (await request.json())['BaseRequest']['Sid']
+        count = self._pending(sid)
+        if count:
+            self._sessions[sid] += count / self.msg_rate
+
+        self._sync_seq += 1
+        self.stats['syncs'] += 1
+        self.stats['messages'] += count
+        return json_response({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'AddMsgCount': count,
+            'AddMsgList': [self._message() for _ in range(count)],
+            'ModContactCount': 0,
+            'ModContactList': [],
+            'DelContactCount': 0,
+            'DelContactList': [],
+            'SyncKey': self.sync_key,
+            'SyncCheckKey': self.sync_key,
+            'ContinueFlag': 0,
+        })
+
+    async def send_msg(self, request):
+        data = await request.json()
+        self.stats['sent'] += 1
+        return json_response({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'MsgID': str(self._msg_id),
+            'LocalID': data['Msg']['LocalID'],
+        })
+
+
+def json_response(data):
+    return web.Response(body=json.dumps(data).encode('utf-8'),
+                        content_type='text/plain', charset='utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--contacts', type=int, default=50000)
+    parser.add_argument('--chatrooms', type=int, default=500)
+    parser.add_argument('--members-per-room', type=int, default=200)
+    parser.add_argument('--msg-rate', type=float, default=2000)
+    args = parser.parse_args()
+
+    server = StubWeChatServer(args.contacts, args.chatrooms,
+                              args.members_per_room, args.msg_rate)
+    loop = asyncio.new_event_loop()
+    base_url = loop.run_until_complete(server.start(args.host, args.port))
+    print('Stub WeChat server on %s' % base_url)
+    for name, url in sorted(server.urls(base_url).items()):
+        print('  %-22s %s' % (name, url))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from .sender import PRIORITY_BULK
+from .storage import run_io
+
+logger = logging.getLogger('sago')
+
+
+def select_groups(*names, predicate=None):
+    """Selector of every member of the named contact groups, optionally
+    filtered by ``predicate(user)``."""
+    def selector(contacts):
+        for name in names:
+            for user in contacts[name].members:
+                if predicate is None or predicate(user):
+                    yield user
+
+    return selector
+
+
+def recipient_key(user):
+    """A key of ``user`` that outlives the web session, unlike UserName:
+    a hash of its remark name, nickname and pinyin. None for a user with
+    no name at all."""
+    names = (user.remark_name, user.nickname, user.py_quanpin)
+    if not any(names):
+        return None
+    return hashlib.sha1('\x1f'.join(names).encode('utf-8')).hexdigest()[:20]
+
+
+class Checkpoint:
+    """Append-only log of the recipients a broadcast has reached.
+
+    Every line holds a recipient's ``recipient_key`` and UserName, under a
+    ``#sid`` line naming the web session that wrote it. Recipients done in
+    the current session are matched by UserName alone. Those done in an
+    earlier session, whose UserNames are gone after a fresh QR login, are
+    matched by key; recipients sharing every name are one recipient then,
+    so a resumed job may skip one of them but never sends twice. The first
+    line records the account's uin, and a checkpoint of another account is
+    refused.
+    """
+
+    def __init__(self, path, flush_size=20):
+        self.path = os.path.abspath(path)
+        self.flush_size = flush_size
+        self.uin = None
+        self.sid = None
+        self._sid_written = False
+        self._pending = []
+
+    def load(self, sid=None):
+        """Return the uin of the checkpoint, and the keys and UserNames to
+        match the recipients done by in session ``sid``."""
+        uin, keys, uids = None, set(), set()
+        line_sid = None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line.startswith('#uin '):
+                        uin = line[5:]
+                    elif line.startswith('#sid '):
+                        line_sid = line[5:]
+                    elif '\t' in line:
+                        key, uid = line.split('\t', 1)
+                        if line_sid is None or line_sid == sid:
+                            uids.add(uid)
+                        if key and line_sid != sid:
+                            keys.add(key)
+                    elif line:
+                        uids.add(line)
+        except FileNotFoundError:
+            pass
+        return uin, keys, uids
+
+    def add(self, user):
+        self._pending.append((recipient_key(user) or '', user.uid))
+        return len(self._pending) >= self.flush_size
+
+    def _write(self, entries):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if f.tell() == 0 and self.uin is not None:
+                f.write('#uin %s\n' % self.uin)
+            if not self._sid_written and self.sid is not None:
+                f.write('#sid %s\n' % self.sid)
+                self._sid_written = True
+            f.write(''.join('%s\t%s\n' % entry for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def flush(self):
+        entries, self._pending = self._pending, []
+        if entries:
+            await run_io(self._write, entries)
+
+
+class BroadcastJob:
+
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, sago, selector, content, checkpoint_path,
+                 concurrency=10, priority=PRIORITY_BULK, on_progress=None):
+        self.sago = sago
+        self.selector = selector
+        self.content = content
+        self.concurrency = concurrency
+        self.priority = priority
+        self.on_progress = on_progress
+        self.checkpoint = Checkpoint(checkpoint_path)
+
+        self.total = 0
+        self.skipped = 0
+        self.done = 0
+        self.failed = []
+        self._started_at = None
+        self._reported_at = 0
+
+    @property
+    def remaining(self):
+        return self.total - self.skipped - self.done - len(self.failed)
+
+    @property
+    def rate(self):
+        if not self._started_at:
+            return 0
+        elapsed = time.monotonic() - self._started_at
+        return self.done / elapsed if elapsed else 0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return self.remaining / rate if rate else None
+
+    def progress(self):
+        return {
+            'total': self.total,
+            'skipped': self.skipped,
+            'done': self.done,
+            'failed': len(self.failed),
+            'remaining': self.remaining,
+            'rate': self.rate,
+            'eta': self.eta,
+        }
+
+    async def run(self):
+        sid = str(self.sago.sid)
+        uin, done_keys, done_uids = await run_io(self.checkpoint.load, sid)
+        own_uin = str(self.sago.uin)
+        if uin is not None and uin != own_uin:
+            raise ValueError('Checkpoint %s belongs to account %s, not %s.'
+                             % (self.checkpoint.path, uin, own_uin))
+        self.checkpoint.uin = own_uin
+        self.checkpoint.sid = sid
+
+        targets = []
+        for user in self.selector(self.sago.contacts):
+            if user.uid in done_uids or recipient_key(user) in done_keys:
+                self.skipped += 1
+            else:
+                targets.append(user)
+        self.total = self.skipped + len(targets)
+
+        logger.info('Broadcast to %d recipients, %d already done.',
+                    self.total, self.skipped)
+
+        self._started_at = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.gather(*[self._send(user, semaphore)
+                                   for user in targets])
+        finally:
+            await self.checkpoint.flush()
+            self._report(force=True)
+
+        return self.progress()
+
+    async def _send(self, user, semaphore):
+        async with semaphore:
+            try:
+                await self.sago.a_send_text(
+                    user.uid, self.content, self.priority)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning('Broadcast to %s failed: %r', user.uid, ex)
+                self.failed.append(user.uid)
+            else:
+                self.done += 1
+                if self.checkpoint.add(user):
+                    await self.checkpoint.flush()
+
+        self._report()
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._reported_at < self.PROGRESS_INTERVAL:
+            return
+
+        self._reported_at = now
+        progress = self.progress()
+        logger.info('Broadcast %(done)d/%(total)d done, %(failed)d failed, '
+                    '%(rate).2f msg/s, eta %(eta)s s', progress)
+        if self.on_progress:
+            self.on_progress(progress)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""JSON codec working on bytes.
+
+Uses orjson or ujson when installed and falls back to the standard library.
+Bodies are decoded straight from the response bytes and encoded as raw UTF-8,
+which is also what webwxsendmsg expects.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+CONTENT_TYPE = 'application/json;charset=UTF-8'
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+
+elif ujson is not None:
+    BACKEND = 'ujson'
+
+    def loads(data):
+        return ujson.loads(data)
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+else:
+    BACKEND = 'json'
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 import asyncio
-import functools
+import http.cookies
 import io
-import json
 import logging
 import re
-import threading
 import time
 import urllib.parse
 import xml.etree.ElementTree as ET
@@ -13,64 +11,172 @@ import xml.etree.ElementTree as ET
 import aiohttp
 import pyqrcode
 
-from .utils.decorators import singleton
+from . import codec
+from .exceptions import SendMessageError
+from .loop import EventLoop
+from .metrics import metrics as default_metrics
+from .pool import (
+    API_POOL, DEFAULT_POOL_CONFIGS, get_connector, POLL_POOL, pool_stats)
 from .utils.functional import random_num
 
 logger = logging.getLogger('sago')
 
+
+def new_local_id():
+    return '%d%s' % (time.time() * 1000, random_num(4))
+
 APPID = 'wx782c26e4c19acffb'
 LANG = 'zh_CN'
 
+ACCOUNT_REQUEST_LIMIT = 4
+
 CHECK_QRCODE_SCANNED_URL = r'https://login.wx.qq.com/cgi-bin/mmwebwx-bin/login'
 GET_ALL_CONTACT_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxgetcontact'
 GET_BATCH_CONTACT_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxbatchgetcontact'
 LOGIN_PAGE_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxnewloginpage'
 LOGIN_QRCODE_URL = r'https://login.weixin.qq.com/l/'
 SYNC_CHECK_URL = r'https://webpush.wx.qq.com/cgi-bin/mmwebwx-bin/synccheck'
+SEND_MSG_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxsendmsg'
 SYNC_DATA_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxsync'
 UUID_URL = r'https://login.weixin.qq.com/jslogin'
 WECHAT_INIT_URL = r'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxinit'
 
+# Endpoint name -> URL; names match the ones used for metrics. Pass
+# ``Core(urls={...})`` to talk to another server, e.g. a local stub.
+URLS = {
+    'request_uuid': UUID_URL,
+    'login_page': LOGIN_PAGE_URL,
+    'listen_qrcode_scanned': CHECK_QRCODE_SCANNED_URL,
+    'init_client': WECHAT_INIT_URL,
+    'request_all_contact': GET_ALL_CONTACT_URL,
+    'batch_get_contact': GET_BATCH_CONTACT_URL,
+    'sync_check': SYNC_CHECK_URL,
+    'sync_data': SYNC_DATA_URL,
+    'send_msg': SEND_MSG_URL,
+}
+
 
 class Core:
+    """One WeChat web session.
 
-    @singleton
-    def __new__(cls, **kwargs):
-        loop = asyncio.get_event_loop()
-        run_event_loop(loop)
+    Every instance has its own cookie jar and auth state, while all instances
+    share the event loop thread and the connection pools, so many accounts
+    can live in one process. Long-polls go through a pool of their own so
+    they never hold connections needed by API requests. ``max_requests`` caps
+    the concurrent API requests of this account so a busy account cannot take
+    the whole API pool.
 
-        instance = super().__new__(cls, **kwargs)
-        instance._client = aiohttp.ClientSession(loop=loop)
-        instance._loop = loop
-        return instance
+    Given ``loop``, the session runs on that loop and no helper thread is
+    started; the caller drives the loop and awaits the coroutines itself.
+    """
 
-    def __init__(self, lang=LANG):
+    def __init__(self, lang=LANG, max_requests=ACCOUNT_REQUEST_LIMIT,
+                 pool_configs=None, metrics=None, urls=None, loop=None):
         self.lang = lang
+        self.urls = dict(URLS, **(urls or {}))
+        self.max_requests = max_requests
+        self.metrics = metrics or default_metrics
+        self.pool_configs = dict(DEFAULT_POOL_CONFIGS, **(pool_configs or {}))
+
+        self._loop = loop or EventLoop()
+        self._cookie_jar = None
+        self._client = None
+        self._poll_client = None
+        self._limiter = None
 
     @property
     def loop(self):
         return self._loop
 
+    @property
+    def cookie_jar(self):
+        if self._cookie_jar is None:
+            self._cookie_jar = aiohttp.CookieJar()
+
+        return self._cookie_jar
+
+    @property
+    def client(self):
+        if self._client is None or self._client.closed:
+            self._client = self._create_session(API_POOL)
+
+        return self._client
+
+    @property
+    def poll_client(self):
+        if self._poll_client is None or self._poll_client.closed:
+            self._poll_client = self._create_session(POLL_POOL)
+
+        return self._poll_client
+
+    def _create_session(self, pool):
+        config = self.pool_configs[pool]
+        return aiohttp.ClientSession(
+            connector=get_connector(self._loop, pool, config),
+            connector_owner=False,
+            cookie_jar=self.cookie_jar,
+            timeout=config.create_timeout())
+
+    def pool_stats(self):
+        return pool_stats(self._loop)
+
+    @property
+    def limiter(self):
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.max_requests)
+
+        return self._limiter
+
     @property
     def reversed_timestamp(self):
         return abs(~int(time.time()))
 
+    async def _request(self, endpoint, method, url=None, poll=False,
+                       **kwargs):
+        """Send a request to ``url`` (by default the endpoint's URL),
+        recording it under ``endpoint``, and return the status and the body
+        as bytes."""
+        url = url or self.urls[endpoint]
+        if 'json' in kwargs:
+            kwargs['data'] = codec.dumps(kwargs.pop('json'))
+            kwargs['headers'] = {'Content-Type': codec.CONTENT_TYPE}
+
+        if poll:
+            return await self._send_request(
+                self.poll_client, endpoint, method, url, kwargs)
+
+        # The time spent waiting for the limiter is our own queueing, so it
+        # is kept out of the endpoint's latency.
+        async with self.limiter:
+            return await self._send_request(
+                self.client, endpoint, method, url, kwargs)
+
+    async def _send_request(self, client, endpoint, method, url, kwargs):
+        with self.metrics.measure(endpoint) as measurement:
+            async with client.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+
+            measurement.observe(resp.status, len(body))
+
+        return resp.status, body
+
     async def request_uuid(self):
         params = {
             'appid': APPID,
             'fun': 'new',
             'lang': self.lang,
-            'redirect_uri': LOGIN_PAGE_URL,
+            'redirect_uri': self.urls['login_page'],
             '_': self.reversed_timestamp,
         }
 
-        async with self._client.get(UUID_URL, params=params) as resp:
-            if resp.status != 200:
-                logger.error('The server returned code %s while request uuid',
-                             resp.status)
-                return
+        status, body = await self._request(
+            'request_uuid', 'GET', params=params)
+        if status != 200:
+            logger.error('The server returned code %s while request uuid',
+                         status)
+            return
 
-            ret = await resp.text()
+        ret = body.decode('utf-8')
 
         m = re.search(
             r'window.QRLogin.code = (?P<status_code>\d+); '
@@ -87,8 +193,7 @@ class Core:
         if storage:
             buff = io.BytesIO()
             qrcode.png(buff, scale=10)
-            fn = functools.partial(storage.save, buff)
-            return await self._loop.run_in_executor(None, fn)
+            return await storage.a_save(buff)
 
         print(qrcode.terminal(quiet_zone=1))
 
@@ -102,23 +207,23 @@ class Core:
         logger.info('Listening the qrcode scan event..')
         params['_'] = self.reversed_timestamp
 
-        async with self._client.get(
-                CHECK_QRCODE_SCANNED_URL, params=params) as resp:
-            print(resp.status)
-            ret = await resp.text()
-            print(ret)
-            return ret
+        status, body = await self._request(
+            'listen_qrcode_scanned', 'GET', poll=True, params=params)
+        ret = body.decode('utf-8')
+        logger.debug('Qrcode scan poll returned %s: %s', status, ret)
+        return ret
 
     async def login_confirm(self, login_page_url):
         params = {
             'version': 'v2',
             'fun': 'new',
         }
-        async with self._client.get(
-                login_page_url + urllib.parse.urlencode(params)) as resp:
-            xml_ret = await resp.text()
+        sep = '&' if '?' in login_page_url else '?'
+        _, body = await self._request(
+            'login_confirm', 'GET',
+            login_page_url + sep + urllib.parse.urlencode(params))
 
-        root = ET.fromstring(xml_ret)
+        root = ET.fromstring(body)
         return {
             'skey': root.find('skey').text,
             'sid': root.find('wxsid').text,
@@ -151,25 +256,42 @@ class Core:
             'lang': self.lang,
         }
 
-        async with self._client.post(
-                WECHAT_INIT_URL, params=params, json=data) as resp:
-            ret = json.loads(await resp.text())
+        _, body = await self._request(
+            'init_client', 'POST', params=params, json=data)
+        ret = codec.loads(body)
 
         return {
             'user_info': ret['User'],
             'sync_key': ret['SyncKey'],
         }
 
+    async def iter_all_contact(self, skey, pass_ticket):
+        seq = 0
+        while True:
+            params = {
+                'skey': skey,
+                'pass_ticket': pass_ticket,
+                'seq': seq,
+                'r': self.reversed_timestamp,
+                'lang': self.lang,
+            }
+            _, body = await self._request(
+                'request_all_contact', 'POST', params=params)
+            ret = codec.loads(body)
+            del body
+
+            member_list = ret.pop('MemberList', None) or ()
+            for user_info in member_list:
+                yield user_info
+            del member_list
+
+            seq = ret.get('Seq', 0)
+            if not seq:
+                break
+
     async def request_all_contact(self, skey, pass_ticket):
-        params = {
-            'skey': skey,
-            'pass_ticket': pass_ticket,
-            'seq': 0,
-            'r': self.reversed_timestamp,
-            'lang': self.lang,
-        }
-        async with self._client.post(GET_ALL_CONTACT_URL, params=params) as resp:
-            return json.loads(await resp.text(encoding='utf-8'))['MemberList']
+        return [user_info async for user_info in
+                self.iter_all_contact(skey, pass_ticket)]
 
     async def sync_check(self, skey, sid, uin, sync_key):
         params = {
@@ -181,12 +303,16 @@ class Core:
             '_': self.reversed_timestamp,
         }
 
-        async with self._client.get(SYNC_CHECK_URL, params=params) as resp:
-            ret = await resp.text()
+        _, body = await self._request(
+            'sync_check', 'GET', poll=True, params=params)
+        ret = body.decode('utf-8')
 
         m = re.search(
-            r'window.synccheck={retcode: "(?P<retcode>\d+)", '
-            r'selector: "(?P<selector>\d+)"}', ret)
+            r'window.synccheck=\{retcode:\s*"(?P<retcode>\d+)",\s*'
+            r'selector:\s*"(?P<selector>\d+)"\}', ret)
+        if not m:
+            raise ValueError('Unexpected synccheck response: %r' % ret)
+
         return m.group('retcode'), m.group('selector')
 
     async def sync_data(self, skey, sid, uin, sync_key, pass_ticket):
@@ -199,9 +325,9 @@ class Core:
         data['SyncKey'] = sync_key
         data['rr'] = self.reversed_timestamp
 
-        async with self._client.post(
-                SYNC_DATA_URL, params=params, json=data) as resp:
-            return json.loads(await resp.text(encoding='utf-8'))
+        _, body = await self._request(
+            'sync_data', 'POST', params=params, json=data)
+        return codec.loads(body)
 
     async def batch_get_contact(self, skey, sid, uin, pass_ticket, *username):
         params = {
@@ -216,15 +342,60 @@ class Core:
             'List': [{'UserName': un, 'EncryChatRoomId': ''} for un in username]
         })
 
-        async with self._client.post(
-                GET_BATCH_CONTACT_URL, params=params, json=data) as resp:
-            return json.loads(await resp.text(encoding='utf-8'))['ContactList']
-
-    def __del__(self):
-        self._client.close()
+        _, body = await self._request(
+            'batch_get_contact', 'POST', params=params, json=data)
+        return codec.loads(body)['ContactList']
 
+    async def send_msg(self, skey, sid, uin, pass_ticket, from_user, to_user,
+                       content, msg_type=1, local_id=None):
+        """Send a message. Pass the same ``local_id`` when retrying one, so
+        the server can tell a retry from a new message."""
+        params = {
+            'pass_ticket': pass_ticket,
+            'lang': self.lang,
+        }
+        local_id = local_id or new_local_id()
+        data = self.get_base_request_data(skey, sid, uin)
+        data.update({
+            'Msg': {
+                'Type': msg_type,
+                'Content': content,
+                'FromUserName': from_user,
+                'ToUserName': to_user,
+                'LocalID': local_id,
+                'ClientMsgId': local_id,
+            },
+            'Scene': 0,
+        })
 
-def run_event_loop(loop):
-    thread = threading.Thread(target=loop.run_forever)
-    thread.daemon = True
-    thread.start()
+        _, body = await self._request(
+            'send_msg', 'POST', params=params, json=data)
+        ret = codec.loads(body)
+
+        if ret['BaseResponse']['Ret'] != 0:
+            raise SendMessageError(ret['BaseResponse']['Ret'],
+                                   ret['BaseResponse'].get('ErrMsg', ''))
+
+        return {'MsgID': ret.get('MsgID'), 'LocalID': ret.get('LocalID')}
+
+    def dump_cookies(self):
+        return [{
+            'key': morsel.key,
+            'value': morsel.value,
+            'domain': morsel['domain'],
+            'path': morsel['path'],
+        } for morsel in self.cookie_jar]
+
+    def load_cookies(self, cookies):
+        jar = http.cookies.SimpleCookie()
+        for cookie in cookies:
+            jar[cookie['key']] = cookie['value']
+            jar[cookie['key']]['domain'] = cookie['domain']
+            jar[cookie['key']]['path'] = cookie['path']
+
+        self.cookie_jar.update_cookies(jar)
+
+    async def close(self):
+        for client in (self._client, self._poll_client):
+            if client is not None:
+                await client.close()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import itertools
+import logging
+
+from .exceptions import OffloadOverloadError
+from .models.message import Message
+from .offload import OffloadedHandler, Offloader
+
+logger = logging.getLogger('sago')
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+SPILL = 'spill'
+
+BACKPRESSURE_POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+
+class Dispatcher:
+    """Bounded message queue served by a pool of handler workers.
+
+    Handlers are registered under a ``(msg_type, group, chat)`` key where any
+    part may be ``None`` as a wildcard, so routing a message is a fixed number
+    of dict lookups regardless of how many handlers exist.
+
+    Handlers registered with ``offload=True`` run on ``offloader``'s process
+    pool; they must be picklable, module level functions.
+
+    With the SPILL policy messages beyond ``maxsize`` wait in an overflow
+    deque of at most ``spill_size`` (ten times ``maxsize`` by default);
+    once that is full too, ``put`` blocks as with BLOCK.
+    """
+
+    def __init__(self, maxsize=1000, workers=4, policy=SPILL, offloader=None,
+                 spill_size=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError('policy should be one of %r' % (
+                BACKPRESSURE_POLICIES,))
+
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.offloader = offloader
+        self.spill_size = spill_size or maxsize * 10
+
+        self._handlers = {}
+        self._queue = None
+        self._spill = collections.deque()
+        self._spill_room = None
+        self._tasks = []
+        self._loop = None
+
+        self.stats = collections.Counter()
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def register(self, msg_type=None, group=None, chat=None, offload=False):
+        if isinstance(msg_type, type) and issubclass(msg_type, Message):
+            msg_type = msg_type.MESSAGE_TYPE
+
+        def decorator(handler):
+            key = (msg_type, group, chat)
+            if offload:
+                if self.offloader is None:
+                    self.offloader = Offloader()
+                entry = OffloadedHandler(handler, self.offloader)
+            else:
+                entry = handler
+            self._handlers.setdefault(key, []).append(entry)
+            return handler
+
+        return decorator
+
+    def unregister(self, handler):
+        for key, handlers in list(self._handlers.items()):
+            handlers[:] = [h for h in handlers
+                           if getattr(h, 'handler', h) is not handler]
+            if not handlers:
+                del self._handlers[key]
+
+    def match(self, message):
+        sender = message.from_user
+        group = getattr(getattr(sender, 'contact_group', None), 'name', None)
+        chat = getattr(sender, 'uid', sender)
+
+        handlers = []
+        for key in itertools.product(
+                _with_wildcard(message.MESSAGE_TYPE),
+                _with_wildcard(group), _with_wildcard(chat)):
+            handlers.extend(self._handlers.get(key, ()))
+        return handlers
+
+    def start(self, loop=None):
+        if self.running:
+            return
+
+        self._loop = loop = loop or asyncio.get_event_loop()
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._spill_room = asyncio.Event()
+        self._tasks = [loop.create_task(self._worker())
+                       for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            self._loop.call_soon_threadsafe(task.cancel)
+        self._tasks = []
+
+    async def put(self, message):
+        self.stats['received'] += 1
+        queue = self._queue
+
+        if not queue.full():
+            queue.put_nowait(message)
+
+        elif self.policy == BLOCK:
+            await queue.put(message)
+
+        elif self.policy == DROP_OLDEST:
+            queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait(message)
+            self.stats['dropped'] += 1
+
+        else:
+            if len(self._spill) >= self.spill_size:
+                self.stats['blocked'] += 1
+                while len(self._spill) >= self.spill_size:
+                    self._spill_room.clear()
+                    await self._spill_room.wait()
+            self._spill.append(message)
+            self.stats['spilled'] += 1
+
+    async def feed(self, messages):
+        for message in messages:
+            await self.put(message)
+
+    def qsize(self):
+        return (self._queue.qsize() if self._queue else 0) + len(self._spill)
+
+    async def join(self):
+        # Spilled messages only exist while the queue is full, and a worker
+        # moves one into the queue before finishing its message, so the
+        # queue's count of unfinished messages covers the spill as well.
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _worker(self):
+        queue = self._queue
+        while True:
+            message = await queue.get()
+            if self._spill:
+                queue.put_nowait(self._spill.popleft())
+                self._spill_room.set()
+
+            try:
+                await self.dispatch(message)
+            finally:
+                queue.task_done()
+
+    async def dispatch(self, message):
+        for handler in self.match(message):
+            try:
+                ret = handler(message)
+                if asyncio.iscoroutine(ret):
+                    await ret
+            except OffloadOverloadError:
+                self.stats['rejected'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('Handler %r failed on message %s',
+                                 handler, message.msg_id)
+            else:
+                self.stats['handled'] += 1
+
+
+def _with_wildcard(value):
+    return (None,) if value is None else (value, None)
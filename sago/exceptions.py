@@ -7,3 +7,25 @@ class LoginTimeoutError(Exception):
 
 class LoginPageUrlNotFound(Exception):
     pass
+
+
+class SendMessageError(Exception):
+
+    def __init__(self, ret, message=''):
+        super().__init__('Send message failed with ret %s. %s' % (ret, message))
+        self.ret = ret
+
+
+class SendCancelledError(SendMessageError):
+
+    def __init__(self, message='The sender stopped before sending.'):
+        Exception.__init__(self, message)
+        self.ret = None
+
+
+class OffloadOverloadError(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Message history kept in SQLite.
+
+The database runs in WAL mode so queries never wait for the writer. Appends
+only put the messages on a queue; a writer thread takes whatever has piled
+up and inserts it in one transaction, so the event loop never touches the
+disk and thousands of messages cost a single commit. Messages are keyed by
+MsgId and inserted with ``INSERT OR IGNORE``, which makes a message that is
+delivered twice a no-op.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from . import codec
+from .models.message import split_sender
+from .storage import run_io
+
+logger = logging.getLogger('sago')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    msg_id TEXT NOT NULL UNIQUE,
+    msg_type INTEGER NOT NULL,
+    chat TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    from_user TEXT NOT NULL,
+    to_user TEXT NOT NULL,
+    create_time INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat, create_time, id);
+CREATE INDEX IF NOT EXISTS messages_sender
+    ON messages (sender, create_time, id);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (create_time, id);
+"""
+
+COLUMNS = ('id', 'msg_id', 'msg_type', 'chat', 'sender', 'from_user',
+           'to_user', 'create_time', 'content', 'extra')
+
+INSERT = ('INSERT OR IGNORE INTO messages (msg_id, msg_type, chat, sender, '
+          'from_user, to_user, create_time, content, extra) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# Fields of Message.dump() that have columns of their own.
+_COLUMN_FIELDS = frozenset(('MsgId', 'MsgType', 'FromUserName', 'ToUserName',
+                            'CreateTime', 'Content'))
+
+_STOP = object()
+
+
+def to_row(data, own_uid=None):
+    """Turn a ``Message.dump()`` into a row of the messages table."""
+    from_user = data['FromUserName']
+    to_user = data['ToUserName']
+    content = data.get('Content') or ''
+
+    # Messages we sent from another device come back with us as sender.
+    chat = to_user if from_user == own_uid else from_user
+    sender = from_user
+    if chat.startswith('@@') and from_user != own_uid:
+        member, content = split_sender(content)
+        sender = member or sender
+
+    extra = {k: v for k, v in data.items() if k not in _COLUMN_FIELDS}
+    return (str(data['MsgId']), int(data.get('MsgType', 0)), chat, sender,
+            from_user, to_user, int(data.get('CreateTime') or 0), content,
+            codec.dumps(extra).decode('utf-8') if extra else None)
+
+
+def to_record(row):
+    record = dict(zip(COLUMNS, row))
+    if record['extra']:
+        record['extra'] = codec.loads(record['extra'])
+    return record
+
+
+class MessageHistory:
+
+    def __init__(self, path, batch_size=1000, flush_interval=0.1,
+                 index=None):
+        self.path = os.path.abspath(path)
+        # A sago.search.SearchIndex fed with every committed row.
+        self.index = index
+        if index is not None and index.texts is None:
+            index.texts = self.contents
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.SimpleQueue()
+        self._local = threading.local()
+        self._writer = None
+        self.stats = {'queued': 0, 'written': 0, 'duplicates': 0,
+                      'batches': 0, 'errors': 0}
+
+        with contextlib.closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(
+                target=self._write_loop, name='sago-history', daemon=True)
+            self._writer.start()
+
+    def append(self, messages, own_uid=None):
+        """Queue ``messages`` for writing; returns at once."""
+        self.start()
+        self._queue.put((own_uid, [m.dump() for m in messages]))
+        self.stats['queued'] += len(messages)
+
+    def flush(self):
+        """Return a future that is done once everything queued so far has
+        been committed."""
+        self.start()
+        future = concurrent.futures.Future()
+        self._queue.put(future)
+        return future
+
+    async def a_flush(self):
+        return await asyncio.wrap_future(self.flush())
+
+    def close(self):
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        self._writer = None
+
+    def _write_loop(self):
+        waiters = []
+        try:
+            with contextlib.closing(self._connect()) as conn:
+                stop = False
+                while not stop:
+                    rows, waiters = [], []
+                    item = self._queue.get()
+                    deadline = time.monotonic() + self.flush_interval
+                    while True:
+                        if item is _STOP:
+                            stop = True
+                            break
+                        elif isinstance(item, concurrent.futures.Future):
+                            waiters.append(item)
+                        else:
+                            own_uid, dumps = item
+                            for data in dumps:
+                                try:
+                                    rows.append(to_row(data, own_uid))
+                                except (KeyError, TypeError, ValueError):
+                                    self.stats['errors'] += 1
+                                    logger.exception('Bad message %r', data)
+
+                        if len(rows) >= self.batch_size:
+                            break
+                        try:
+                            item = self._queue.get(
+                                timeout=max(0, deadline - time.monotonic()))
+                        except queue.Empty:
+                            break
+
+                    if rows:
+                        self._write(conn, rows)
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        except Exception as ex:
+            self.stats['errors'] += 1
+            logger.exception('History writer failed.')
+            self._writer_failed(waiters, ex)
+
+    def _writer_failed(self, waiters, ex):
+        # Fail every flush waiting on this writer; queued messages stay
+        # queued for the writer the next append or flush starts.
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, concurrent.futures.Future):
+                waiters.append(item)
+            elif item is not _STOP:
+                items.append(item)
+
+        for item in items:
+            self._queue.put(item)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(ex)
+
+    def _write(self, conn, rows):
+        try:
+            with conn:
+                last_id = conn.execute(
+                    'SELECT MAX(id) FROM messages').fetchone()[0] or 0
+                inserted = conn.executemany(INSERT, rows).rowcount
+        except sqlite3.Error:
+            self.stats['errors'] += 1
+            logger.exception('Writing %d messages to history failed.',
+                             len(rows))
+            return
+
+        self.stats['batches'] += 1
+        self.stats['written'] += inserted
+        self.stats['duplicates'] += len(rows) - inserted
+
+        if self.index is not None and inserted:
+            # Only this thread writes, so rows past the old maximum are
+            # exactly the ones just inserted.
+            new_rows = conn.execute(
+                'SELECT %s FROM messages WHERE id > ? ORDER BY id'
+                % ', '.join(COLUMNS), (last_id,))
+            try:
+                self.index.add_all(to_record(row) for row in new_rows)
+            except Exception:
+                logger.exception('Indexing messages failed.')
+
+    # queries, run on the calling thread
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def get(self, msg_id):
+        row = self._reader().execute(
+            'SELECT %s FROM messages WHERE msg_id = ?' % ', '.join(COLUMNS),
+            (str(msg_id),)).fetchone()
+        return to_record(row) if row else None
+
+    def get_rows(self, ids):
+        """Records of the row ``ids``, in the same order."""
+        if not ids:
+            return []
+        rows = self._reader().execute(
+            'SELECT %s FROM messages WHERE id IN (%s)' % (
+                ', '.join(COLUMNS), ', '.join('?' * len(ids))), ids)
+        records = {row[0]: to_record(row) for row in rows}
+        return [records[i] for i in ids if i in records]
+
+    def contents(self, ids):
+        """The contents of the row ``ids``, by id."""
+        if not ids:
+            return {}
+        return dict(self._reader().execute(
+            'SELECT id, content FROM messages WHERE id IN (%s)'
+            % ', '.join('?' * len(ids)), ids))
+
+    def search(self, query, **filters):
+        """Records of the messages matching ``query``, best first; takes
+        the filters of SearchIndex.search."""
+        if self.index is None:
+            raise ValueError('History has no search index.')
+        hits = self.index.search(query, **filters)
+        return self.get_rows([row_id for row_id, _ in hits])
+
+    def query(self, chat=None, sender=None, since=None, until=None,
+              limit=100, before=None):
+        """Messages newest first, filtered by chat, sender and a
+        ``[since, until)`` range of CreateTime.
+
+        Returns the records and a cursor; pass the cursor as ``before`` to
+        get the next page, it is None on the last page.
+        """
+        where, args = [], []
+        if chat is not None:
+            where.append('chat = ?')
+            args.append(chat)
+        if sender is not None:
+            where.append('sender = ?')
+            args.append(sender)
+        if since is not None:
+            where.append('create_time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('create_time < ?')
+            args.append(until)
+        if before is not None:
+            where.append('(create_time, id) < (?, ?)')
+            args.extend(before)
+
+        sql = 'SELECT %s FROM messages' % ', '.join(COLUMNS)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY create_time DESC, id DESC LIMIT ?'
+        args.append(limit)
+
+        records = [to_record(row)
+                   for row in self._reader().execute(sql, args)]
+        cursor = None
+        if len(records) == limit:
+            cursor = (records[-1]['create_time'], records[-1]['id'])
+        return records, cursor
+
+    def iter_all(self, batch_size=5000):
+        """Every stored message, oldest first."""
+        last_id = 0
+        sql = ('SELECT %s FROM messages WHERE id > ? ORDER BY id LIMIT ?'
+               % ', '.join(COLUMNS))
+        while True:
+            rows = self._reader().execute(sql, (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield to_record(row)
+            last_id = rows[-1][0]
+
+    def count(self, chat=None):
+        if chat is None:
+            sql, args = 'SELECT COUNT(*) FROM messages', ()
+        else:
+            sql, args = 'SELECT COUNT(*) FROM messages WHERE chat = ?', (chat,)
+        return self._reader().execute(sql, args).fetchone()[0]
+
+    async def a_get(self, msg_id):
+        return await run_io(self.get, msg_id)
+
+    async def a_query(self, **kwargs):
+        return await run_io(lambda: self.query(**kwargs))
+
+    async def a_search(self, query, **filters):
+        return await run_io(lambda: self.search(query, **filters))
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import os
+
+logger = logging.getLogger('sago')
+
+THUMB_PRIORITY = 0
+FULL_PRIORITY = 1
+
+CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+
+
+class PriorityGate:
+    """A semaphore that hands free slots to the lowest priority waiter."""
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self._value += 1
+
+
+class MediaFetcher:
+    """Downloads message media, once per image: messages carrying the same
+    image or sticker share the download and its result, matched by the md5
+    in their content, or by URL for media without one."""
+
+    # Results kept for messages arriving after a download finished.
+    CACHE_SIZE = 1024
+
+    def __init__(self, core, storage, concurrency=4, chunk_size=64 * 1024):
+        self.core = core
+        self.storage = storage
+        self.chunk_size = chunk_size
+
+        self._gate = PriorityGate(concurrency)
+        self._inflight = {}
+        self._done = collections.OrderedDict()
+
+    async def fetch(self, message, thumb=False):
+        url = message.thumb_url if thumb else message.url
+        if not url:
+            return
+
+        key = (getattr(message, 'md5', None) or url, thumb)
+        path = self._done.get(key)
+        if path is not None:
+            if not isinstance(path, str) or os.path.exists(path):
+                self._done.move_to_end(key)
+                return path
+            del self._done[key]
+
+        future = self._inflight.get(key)
+        if future is None:
+            name = '%s%s' % (message.msg_id, '_thumb' if thumb else '')
+            priority = THUMB_PRIORITY if thumb else FULL_PRIORITY
+            future = self._inflight[key] = asyncio.ensure_future(
+                self._download(url, name, priority))
+            future.add_done_callback(
+                functools.partial(self._downloaded, key))
+
+        return await asyncio.shield(future)
+
+    def _downloaded(self, key, future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self._done[key] = future.result()
+        if len(self._done) > self.CACHE_SIZE:
+            self._done.popitem(last=False)
+
+    async def fetch_all(self, messages, thumb=True, full=True):
+        """Fetch the media of ``messages``, every thumbnail before any full
+        image. Returns ``(thumb_path, path)`` per message."""
+        thumbs = [self.fetch(m, thumb=True) if thumb else _none()
+                  for m in messages]
+        fulls = [self.fetch(m) if full else _none() for m in messages]
+        results = await asyncio.gather(*(thumbs + fulls))
+        return list(zip(results[:len(messages)], results[len(messages):]))
+
+    async def _download(self, url, name, priority):
+        await self._gate.acquire(priority)
+        try:
+            with self.core.metrics.measure('media') as measurement:
+                async with self.core.client.get(url) as resp:
+                    resp.raise_for_status()
+                    f = await self.storage.a_open(
+                        name + CONTENT_TYPE_EXTENSIONS.get(
+                            resp.content_type, ''))
+                    size = 0
+                    try:
+                        async for chunk in resp.content.iter_chunked(
+                                self.chunk_size):
+                            size += len(chunk)
+                            await f.write(chunk)
+                    except BaseException:
+                        await f.discard()
+                        raise
+
+                    measurement.observe(resp.status, size)
+                    return await f.close()
+        finally:
+            self._gate.release()
+
+
+async def _none():
+    return
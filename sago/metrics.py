@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import collections
+import logging
+import time
+
+logger = logging.getLogger('sago')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts observations above the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class EndpointStats:
+
+    __slots__ = ('latency', 'statuses', 'errors', 'response_bytes')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.response_bytes = 0
+
+    def record(self, latency, status, size, error):
+        self.latency.observe(latency)
+        if status is not None:
+            self.statuses[status] += 1
+        if error is not None:
+            self.errors[error] += 1
+        self.response_bytes += size
+
+    def as_dict(self):
+        count = self.latency.count
+        return {
+            'requests': count,
+            'mean_latency': self.latency.sum / count if count else 0,
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'response_bytes': self.response_bytes,
+        }
+
+
+class BaseSink:
+
+    def record(self, endpoint, latency, status, size, error):
+        pass
+
+
+class StatsSink(BaseSink):
+    """Keeps per-endpoint histograms and counters in memory."""
+
+    def __init__(self):
+        self.endpoints = collections.defaultdict(EndpointStats)
+
+    def record(self, endpoint, latency, status, size, error):
+        self.endpoints[endpoint].record(latency, status, size, error)
+
+    def as_dict(self):
+        return {name: stats.as_dict()
+                for name, stats in self.endpoints.items()}
+
+
+class PrometheusSink(StatsSink):
+
+    NAMESPACE = 'sago'
+
+    def render(self):
+        ns = self.NAMESPACE
+        lines = [
+            '# TYPE %s_request_duration_seconds histogram' % ns,
+        ]
+        for endpoint, stats in sorted(self.endpoints.items()):
+            for bound, total in stats.latency.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(
+                    '%s_request_duration_seconds_bucket{endpoint="%s",'
+                    'le="%s"} %d' % (ns, endpoint, le, total))
+            lines.append('%s_request_duration_seconds_sum{endpoint="%s"} %r'
+                         % (ns, endpoint, stats.latency.sum))
+            lines.append('%s_request_duration_seconds_count{endpoint="%s"} %d'
+                         % (ns, endpoint, stats.latency.count))
+
+        lines.append('# TYPE %s_responses_total counter' % ns)
+        for endpoint, stats in sorted(self.endpoints.items()):
+            for status, count in sorted(stats.statuses.items()):
+                lines.append('%s_responses_total{endpoint="%s",status="%s"} %d'
+                             % (ns, endpoint, status, count))
+
+        lines.append('# TYPE %s_response_bytes_total counter' % ns)
+        for endpoint, stats in sorted(self.endpoints.items()):
+            lines.append('%s_response_bytes_total{endpoint="%s"} %d'
+                         % (ns, endpoint, stats.response_bytes))
+
+        lines.append('# TYPE %s_errors_total counter' % ns)
+        for endpoint, stats in sorted(self.endpoints.items()):
+            for error, count in sorted(stats.errors.items()):
+                lines.append('%s_errors_total{endpoint="%s",error="%s"} %d'
+                             % (ns, endpoint, error, count))
+
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        """Serve ``/metrics`` on the running loop; returns the runner, call
+        ``await runner.cleanup()`` to stop."""
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(),
+                                content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+class Measurement:
+
+    __slots__ = ('metrics', 'endpoint', 'started_at', 'status', 'size')
+
+    def __init__(self, metrics, endpoint):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.status = None
+        self.size = 0
+
+    def observe(self, status, size):
+        self.status = status
+        self.size = size
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A cancelled request, such as a pipelined sync_check dropped at
+        # logout, neither succeeded nor failed.
+        if exc_type is not None and issubclass(
+                exc_type, asyncio.CancelledError):
+            return
+        self.metrics.record(
+            self.endpoint, time.perf_counter() - self.started_at, self.status,
+            self.size, exc_type.__name__ if exc_type else None)
+
+
+class Metrics:
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def measure(self, endpoint):
+        return Measurement(self, endpoint)
+
+    def record(self, endpoint, latency, status, size, error):
+        for sink in self.sinks:
+            try:
+                sink.record(endpoint, latency, status, size, error)
+            except Exception:
+                logger.exception('Metrics sink %r failed', sink)
+
+
+# Shared by every Core unless one is given its own.
+metrics = Metrics(StatsSink())
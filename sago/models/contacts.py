@@ -1,38 +1,348 @@
 # -*- coding: utf-8 -*-
-from .user import AbstractUser
+import bisect
+import collections
+import heapq
+import time
+import weakref
+
+from .user import AbstractUser, ChatRoom, create_user
 
 
 class Contacts(dict):
 
-    def __init__(self):
-        self.count = 0
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._index = {}
+        # uid -> expiry of the users added by ``cache_user``, oldest first.
+        self._expiry = collections.OrderedDict()
+        # Chatroom members that are not in any contact group, kept alive only
+        # by the chatrooms referencing them.
+        self._strangers = weakref.WeakValueDictionary()
+        # member uid -> uids of the chatrooms it is in, the reverse of
+        # ChatRoom's member dict.
+        self._memberships = {}
+        self._names = ContactIndex()
+        # Bumped on every change, to tell whether a saved copy is stale.
+        self.version = 0
 
     def add(self, key, contact_group):
+        contact_group.name = key
         self[key] = contact_group
-        self.count += len(contact_group)
+        for user in contact_group.members:
+            self._index[user.uid] = user
+            self._names.add(user)
 
-    def __getattribute__(self, name):
+    def __getattr__(self, name):
         try:
             return self[name]
         except KeyError:
-            return super().__getattribute__(name)
+            raise AttributeError(name)
+
+    @property
+    def count(self):
+        return len(self._index)
+
+    def get_user(self, uid):
+        return self._index.get(uid)
 
     def search(self, key):
+        user = self._index.get(key)
+        if user:
+            return user
+
         for group in self.values():
             user = group.search(key)
             if user:
                 return user
 
+    def find(self, query, limit=20):
+        """Contacts whose nickname, remark name, display name or pinyin
+        (full or initials) is ``query`` or starts with it, exact matches
+        first."""
+        return [self._index[uid] for uid in self._names.find(query, limit)]
+
+    def get_or_create_member(self, member_data, skey):
+        uid = member_data['UserName']
+        member = self._index.get(uid) or self._strangers.get(uid)
+        if member is None:
+            member = create_user(member_data, skey)
+            if member is not None:
+                self._strangers[member.uid] = member
+
+        return member
+
     def add_user(self, user):
+        old = self._index.get(user.uid) or self._strangers.pop(user.uid, None)
+        if old is not None:
+            if old.contact_group is not None:
+                old.contact_group.remove(old.uid)
+            if type(old) is type(user):
+                old.merge(user)
+                user = old
+
+        self._expiry.pop(user.uid, None)
         for group in self.values():
             if isinstance(user, group.member_type):
+                self.version += 1
                 group.add(user)
-                self.count += 1
+                self._index[user.uid] = user
+                self._names.add(user)
+                return user
+
+    def cache_user(self, user):
+        """Add ``user`` to be dropped again after ``ttl`` seconds."""
+        user = self.add_user(user)
+        if user is not None and self.ttl:
+            self._expiry[user.uid] = time.monotonic() + self.ttl
+        return user
+
+    def expire(self, now=None):
+        now = now or time.monotonic()
+        expired = []
+        while self._expiry:
+            uid, expires_at = next(iter(self._expiry.items()))
+            if expires_at > now:
+                break
+            del self._expiry[uid]
+            user = self.remove_user(uid)
+            if user:
+                expired.append(user)
+        return expired
+
+    def remove_user(self, uid):
+        self._expiry.pop(uid, None)
+        user = self._index.pop(uid, None)
+        self._names.remove(uid)
+        if user is not None:
+            self.version += 1
+        if user is not None and user.contact_group is not None:
+            user.contact_group.remove(uid)
+        if isinstance(user, ChatRoom):
+            self.set_members(user, ())
+        if user is not None and uid in self._memberships:
+            # Still a member of chatrooms, which must keep finding this
+            # object rather than make a second one for the same UserName.
+            self._strangers[uid] = user
+        return user
+
+    def set_members(self, chatroom, members):
+        """Make ``members`` the member list of ``chatroom``, changing only
+        what differs. Returns the users that joined and the users that
+        left."""
+        room_uid = chatroom.uid
+        members = {m.uid: m for m in members}
+
+        left = []
+        for uid in [uid for uid in chatroom.member_uids()
+                    if uid not in members]:
+            left.append(chatroom.remove(uid))
+            rooms = self._memberships.get(uid)
+            if rooms is not None:
+                rooms.discard(room_uid)
+                if not rooms:
+                    del self._memberships[uid]
+
+        joined = []
+        for uid, member in members.items():
+            if uid not in chatroom:
+                chatroom.add(member)
+                self._memberships.setdefault(uid, set()).add(room_uid)
+                joined.append(member)
+
+        if joined or left:
+            self.version += 1
+        return joined, left
+
+    def chatrooms_of(self, user):
+        """The chatrooms ``user`` (a user or a uid) is a member of."""
+        rooms = self._memberships.get(getattr(user, 'uid', user), ())
+        return [self._index[uid] for uid in rooms if uid in self._index]
+
+    def common_chatrooms(self, *users):
+        """The chatrooms every one of ``users`` is a member of."""
+        room_sets = sorted(
+            (self._memberships.get(getattr(u, 'uid', u), set())
+             for u in users), key=len)
+        if not room_sets:
+            return []
+
+        common = room_sets[0].intersection(*room_sets[1:])
+        return [self._index[uid] for uid in common if uid in self._index]
+
+    def snapshot(self):
+        """The users of every group and the members of every chatroom, as
+        lists of references; cheap enough to take on the loop, with the
+        costly dumping left to ``dump_snapshot`` on another thread."""
+        groups = {name: group.members for name, group in self.items()}
+        rooms = {room.uid: room.members
+                 for room in groups.get('chatrooms', ())}
+        return groups, rooms
+
+    def load_snapshot(self, data, skey, cache=False):
+        """Add the users of a ``dump_snapshot`` result, with ``cache_user``
+        if ``cache`` is true; returns them."""
+        add_user = self.cache_user if cache else self.add_user
+        users = []
+        for name, dumps in data.get('groups', {}).items():
+            if name not in self:
+                continue
+            member_type = self[name].member_type
+            for user_info in dumps:
+                user_info['skey'] = skey
+                user = add_user(member_type(user_info))
+                if user is not None:
+                    users.append(user)
+
+        strangers = data.get('strangers', {})
+        for room_uid, uids in data.get('members', {}).items():
+            room = self._index.get(room_uid)
+            if not isinstance(room, ChatRoom):
+                continue
+            members = []
+            for uid in uids:
+                member = self._index.get(uid)
+                if member is None and uid in strangers:
+                    member = self.get_or_create_member(strangers[uid], skey)
+                if member is not None:
+                    members.append(member)
+            self.set_members(room, members)
+        return users
+
+    def apply_sync(self, sync_data, skey):
+        """Apply ``ModContactList``/``DelContactList`` of a webwxsync result.
+
+        Returns the pairs of ``(user, user_info)`` that were added or
+        replaced, and the users that were removed.
+        """
+        updated = []
+        for user_info in sync_data.get('ModContactList') or ():
+            user = create_user(user_info, skey)
+            user = user and self.add_user(user)
+            if user:
+                updated.append((user, user_info))
+
+        removed = []
+        for user_info in sync_data.get('DelContactList') or ():
+            user = self.remove_user(user_info['UserName'])
+            if user:
+                removed.append(user)
+
+        return updated, removed
 
     def __repr__(self):
         return '<Contacts members: %d>' % self.count
 
 
+def dump_snapshot(snapshot):
+    """Plain data of a ``Contacts.snapshot()``. Chatrooms list their
+    members by UserName; members that are nobody's contact are dumped once
+    under ``strangers``."""
+    groups, rooms = snapshot
+    data = {'groups': {}, 'members': {}, 'strangers': {}}
+    known = set()
+    for name, users in groups.items():
+        data['groups'][name] = [u.dump() for u in users]
+        known.update(u.uid for u in users)
+
+    strangers = data['strangers']
+    for room_uid, members in rooms.items():
+        data['members'][room_uid] = [m.uid for m in members]
+        for member in members:
+            if member.uid not in known and member.uid not in strangers:
+                strangers[member.uid] = member.dump()
+    return data
+
+
+class ContactIndex:
+    """Maps lowercased names to the uids having them.
+
+    Prefix lookups bisect a sorted list of the names. New names are only
+    put into it by the next lookup, one by one when there are few and with
+    a merge after bulk loads. Names nobody has any more are skipped until
+    enough of them pile up to be worth a rebuild.
+    """
+
+    INSORT_LIMIT = 256
+
+    def __init__(self):
+        self._uids = {}
+        self._keys_of = {}
+        self._sorted = []
+        self._new = []
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._uids)
+
+    def add(self, user):
+        self.remove(user.uid)
+        keys = user.search_keys()
+        self._keys_of[user.uid] = keys
+        for key in keys:
+            uids = self._uids.get(key)
+            if uids is None:
+                uids = self._uids[key] = set()
+                self._new.append(key)
+            uids.add(user.uid)
+
+    def remove(self, uid):
+        for key in self._keys_of.pop(uid, ()):
+            uids = self._uids[key]
+            uids.discard(uid)
+            if not uids:
+                del self._uids[key]
+                self._stale += 1
+
+    def _sorted_keys(self):
+        keys = self._sorted
+        if (len(self._new) > self.INSORT_LIMIT or
+                self._stale > len(keys) // 4 + self.INSORT_LIMIT):
+            merged = []
+            self._new.sort()
+            for key in heapq.merge(keys, self._new):
+                # A name removed and added back is in both lists.
+                if key in self._uids and (not merged or merged[-1] != key):
+                    merged.append(key)
+            self._sorted = keys = merged
+            self._new = []
+            self._stale = 0
+        elif self._new:
+            for key in self._new:
+                i = bisect.bisect_left(keys, key)
+                if i == len(keys) or keys[i] != key:
+                    keys.insert(i, key)
+            self._new = []
+        return keys
+
+    def exact(self, key):
+        return self._uids.get(key.strip().lower(), set())
+
+    def prefix(self, prefix):
+        """Names starting with ``prefix``, in order."""
+        keys = self._sorted_keys()
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            if keys[i] in self._uids:
+                yield keys[i]
+            i += 1
+
+    def find(self, query, limit=20):
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        found = list(self._uids.get(query, ()))[:limit]
+        seen = set(found)
+        for key in self.prefix(query):
+            if len(found) >= limit:
+                break
+            for uid in self._uids[key]:
+                if uid not in seen:
+                    seen.add(uid)
+                    found.append(uid)
+        return found[:limit]
+
+
 class ContactGroup:
 
     def __init__(self, member_type):
@@ -40,35 +350,54 @@ class ContactGroup:
             raise TypeError('member_type should be subclass of AbstractUser')
 
         self.member_type = member_type
+        self.name = None
         self._members = {}
         self._nick_name_index = {}
-        self._count = 0
 
     def add(self, *users):
         for u in users:
             if isinstance(u, self.member_type):
+                self.remove(u.uid)
                 self._members[u.uid] = u
-                self._nick_name_index[u.nickname] = u
+                self._nick_name_index.setdefault(u.nickname, []).append(u)
 
                 u.contact_group = self
-                self._count += 1
+
+    def remove(self, uid):
+        user = self._members.pop(uid, None)
+        if user is None:
+            return
+
+        same_name = self._nick_name_index.get(user.nickname, [])
+        if user in same_name:
+            same_name.remove(user)
+        if not same_name:
+            self._nick_name_index.pop(user.nickname, None)
+
+        user.contact_group = None
+        return user
 
     def search(self, key):
         user = self._members.get(key)
         if user:
             return user
-        else:
-            return self._nick_name_index.get(key)
+
+        same_name = self._nick_name_index.get(key)
+        if same_name:
+            return same_name[0]
+
+    def search_all(self, nickname):
+        return list(self._nick_name_index.get(nickname, ()))
 
     @property
     def members(self):
         return list(self._members.values())
 
     def count(self):
-        return self._count
+        return len(self._members)
 
     def __len__(self):
-        return self._count
+        return len(self._members)
 
     def __repr__(self):
         return str(self.members)
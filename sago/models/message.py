@@ -1,23 +1,45 @@
 # -*- coding: utf-8 -*-
+import html
+import re
+import xml.etree.ElementTree as ET
 from urllib.parse import urlencode
 
+_UNSET = object()
+
+_MD5_RE = re.compile(r'\bmd5\s*=\s*"([0-9a-fA-F]{32})"')
+
+
+def split_sender(content):
+    """Split the ``@sender:<br/>`` prefix off the content of a chatroom
+    message; returns the sender's UserName, or None, and the rest."""
+    if content.startswith('@'):
+        sender, sep, rest = content.partition(':<br/>')
+        if sep:
+            return sender, rest
+    return None, content
+
 
 class Message:
 
     MESSAGE_TYPE = -1
 
-    def __init__(self, **kwargs):
-        assert 'MsgId' in kwargs, 'Message should contains MsgId.'
-        assert 'ToUserName' in kwargs, 'Message should contains ToUserName.'
-        assert 'FromUserName' in kwargs, 'Message should contains FromUserName.'
-        assert 'Content' in kwargs, 'Message should contains Content.'
+    # Keys of the webwxsync payload kept in ``raw``; a full AddMsgList entry
+    # carries some thirty fields we never read.
+    RAW_FIELDS = ('MsgId', 'MsgType', 'FromUserName', 'ToUserName', 'Content',
+                  'CreateTime')
+
+    __slots__ = ('_msg_id', '_to', '_from', '_raw', '_skey', '_content')
 
-        self._msg_id = kwargs['MsgId']
-        self._to = kwargs['ToUserName']
-        self._from = kwargs['FromUserName']
-        self._raw = kwargs
+    def __init__(self, msg_data, from_user=None, to_user=None, skey=''):
+        self._msg_id = msg_data['MsgId']
+        self._from = from_user or msg_data['FromUserName']
+        self._to = to_user or msg_data['ToUserName']
+        self._raw = {k: msg_data[k] for k in self.RAW_FIELDS if k in msg_data}
+        self._skey = skey
+        self._content = _UNSET
 
-        self.parse_content(kwargs.get('Content'))
+    def __repr__(self):
+        return '<%s id: %s>' % (self.__class__.__name__, self._msg_id)
 
     @property
     def msg_id(self):
@@ -31,80 +53,164 @@ class Message:
     def from_user(self):
         return self._from
 
+    @property
+    def skey(self):
+        return self._skey
+
+    @property
+    def create_time(self):
+        return self._raw.get('CreateTime', 0)
+
     @property
     def raw(self):
         return self._raw
 
     @property
     def content(self):
+        if self._content is _UNSET:
+            self._content = self.parse_content(self._raw.get('Content', ''))
         return self._content
 
     def parse_content(self, content):
-        self._content = content
         return content
 
+    def dump(self):
+        """The message as a small dict of plain values, enough for
+        MessageFactory.build to make it again."""
+        return dict(self._raw)
+
 
 class TextMessage(Message):
 
     MESSAGE_TYPE = 1
 
+    __slots__ = ()
+
 
 class PictureMessage(Message):
 
     MESSAGE_TYPE = 3
     FETCH_PICTURE_URL = 'https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxgetmsgimg'
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+    __slots__ = ('_url', '_thumb_url', '_md5')
 
-        assert 'skey' in kwargs, 'An argument skey is expected.'
+    def __init__(self, msg_data, from_user=None, to_user=None, skey=''):
+        super().__init__(msg_data, from_user, to_user, skey)
+        self._url = self._thumb_url = self._md5 = _UNSET
 
+    @property
+    def md5(self):
+        """The md5 of the media from the ``<img>``/``<emoji>`` element of
+        the content, the same for every message carrying it; or None."""
+        if self._md5 is _UNSET:
+            m = _MD5_RE.search(html.unescape(self._raw.get('Content', '')))
+            self._md5 = m.group(1).lower() if m else None
+        return self._md5
+
+    def build_url(self, image_type):
         params = {
             'MsgID': self._msg_id,
-            'skey': kwargs['skey'],
-            'type': 'big'
+            'skey': self._skey,
+            'type': image_type,
         }
+        return '?'.join((self.FETCH_PICTURE_URL, urlencode(params)))
 
-        self._url = '?'.join((self.FETCH_PICTURE_URL, urlencode(params)))
+    @property
+    def url(self):
+        if self._url is _UNSET:
+            self._url = self.build_url('big')
+        return self._url
 
-        params['type'] = 'slave'
-        self._thumb_url = '?'.join((self.FETCH_PICTURE_URL, urlencode(params)))
+    @property
+    def thumb_url(self):
+        if self._thumb_url is _UNSET:
+            self._thumb_url = self.build_url('slave')
+        return self._thumb_url
 
 
 class EmotionMessage(PictureMessage):
 
     MESSAGE_TYPE = 47
 
+    __slots__ = ()
+
+    def build_url(self, image_type):
+        if not self._raw.get('Content'):
+            return ''
+        return super().build_url(image_type)
+
     def parse_content(self, content):
         if not content:
-            self._url = self._thumb_url = ''
-            self._content = '[发送了一个表情，请在手机上查看]'
-        else:
-            self._content = content
+            return '[发送了一个表情，请在手机上查看]'
+        return content
 
-        return self._content
+
+class AppMessage(Message):
+
+    MESSAGE_TYPE = 49
+    RAW_FIELDS = Message.RAW_FIELDS + ('AppMsgType', 'FileName', 'Url')
+
+    __slots__ = ('_payload',)
+
+    def __init__(self, msg_data, from_user=None, to_user=None, skey=''):
+        super().__init__(msg_data, from_user, to_user, skey)
+        self._payload = _UNSET
+
+    @property
+    def app_msg_type(self):
+        return self._raw.get('AppMsgType', 0)
+
+    @property
+    def title(self):
+        return self._raw.get('FileName', '')
+
+    @property
+    def url(self):
+        return self._raw.get('Url', '')
+
+    @property
+    def payload(self):
+        """The ``<msg><appmsg>`` element of the content, or None."""
+        if self._payload is _UNSET:
+            self._payload = self.parse_payload(self._raw.get('Content', ''))
+        return self._payload
+
+    def parse_payload(self, content):
+        _, content = split_sender(html.unescape(content))
+
+        try:
+            return ET.fromstring(content.strip()).find('appmsg')
+        except ET.ParseError:
+            return
 
 
 class UnknownMessage(Message):
 
     MESSAGE_TYPE = -2
 
+    __slots__ = ()
+
 
 class MessageFactory:
-    MESSAGE_TYPES = {
-        TextMessage.MESSAGE_TYPE: TextMessage,
-        PictureMessage.MESSAGE_TYPE: PictureMessage,
-        EmotionMessage.MESSAGE_TYPE: EmotionMessage,
-    }
+    MESSAGE_TYPES = {cls.MESSAGE_TYPE: cls for cls in (
+        TextMessage, PictureMessage, EmotionMessage, AppMessage)}
 
-    def __init__(self, contacts):
+    def __init__(self, contacts, skey=None):
         self.contacts = contacts
+        self.skey = skey
 
     def build(self, msg_data):
         msg_cls = self.MESSAGE_TYPES.get(msg_data['MsgType'], UnknownMessage)
-        msg_data['FromUserName'] = self.contacts.search(
-            msg_data['FromUserName'])
-        msg_data['ToUserName'] = self.contacts.search(
-            msg_data['ToUserName'])
-
-
+        get_user = self.contacts.get_user
+        return msg_cls(msg_data, get_user(msg_data['FromUserName']),
+                       get_user(msg_data['ToUserName']), self.skey)
+
+    def build_all(self, msg_list):
+        types = self.MESSAGE_TYPES
+        get_user = self.contacts.get_user
+        skey = self.skey
+        return [
+            types.get(d['MsgType'], UnknownMessage)(
+                d, get_user(d['FromUserName']), get_user(d['ToUserName']),
+                skey)
+            for d in msg_list]
@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
+import sys
 
 
 class AbstractUser:
 
-    def __init__(self, initial_data, skey):
+    __slots__ = ('_uid', '_nickname', '_head_img_url', '_skey', '_city',
+                 'remark_name', 'display_name', 'py_initial', 'py_quanpin',
+                 'remark_py_initial', 'remark_py_quanpin', 'contact_group',
+                 '__weakref__')
+
+    # Payload fields kept as they are, slot name -> key.
+    _NAME_FIELDS = (
+        ('remark_name', 'RemarkName'),
+        ('display_name', 'DisplayName'),
+        ('py_initial', 'PYInitial'),
+        ('py_quanpin', 'PYQuanPin'),
+        ('remark_py_initial', 'RemarkPYInitial'),
+        ('remark_py_quanpin', 'RemarkPYQuanPin'),
+    )
+
+    # Slots that belong to the contact rather than to its place in Contacts.
+    _MERGE_EXCLUDED = frozenset(('contact_group', '__weakref__', '_members'))
+
+    def __init__(self, initial_data):
         if not initial_data.get('UserName'):
             raise ValueError('Intial data should contains UserName.')
 
-        self._uid = initial_data['UserName']
+        self._uid = sys.intern(initial_data['UserName'])
         self._nickname = initial_data.get('NickName', '')
-        self._avatar_url = ''
-        if initial_data.get('HeadImgUrl'):
-            self._avatar_url = ''.join((
-                'https://wx.qq.com', initial_data['HeadImgUrl'],
-                initial_data['skey']))
-
+        self._head_img_url = initial_data.get('HeadImgUrl', '')
+        self._skey = initial_data.get('skey', '')
         self._city = initial_data.get('City', '')
+        for name, key in self._NAME_FIELDS:
+            setattr(self, name, initial_data.get(key) or '')
+        self.contact_group = None
 
     def __repr__(self):
         return '<%s id: %s nickname: %s>' % (
@@ -27,26 +45,60 @@ class AbstractUser:
 
     @property
     def nickname(self):
-        return self.nickname
+        return self._nickname
 
     @property
     def avatar_url(self):
-        return self._avatar_url
+        if not self._head_img_url:
+            return ''
+
+        return ''.join(('https://wx.qq.com', self._head_img_url, self._skey))
 
     @property
     def city(self):
-        return self.city
+        return self._city
+
+    def search_keys(self):
+        """The names this user can be looked up by, lowercased."""
+        keys = {self._nickname.lower()}
+        for name, _ in self._NAME_FIELDS:
+            keys.add(getattr(self, name).lower())
+        keys.discard('')
+        return keys
+
+    def merge(self, other):
+        """Copy the contact fields of ``other`` into this instance in place,
+        so every chatroom holding this object sees the update."""
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name not in self._MERGE_EXCLUDED:
+                    setattr(self, name, getattr(other, name))
+
+    def dump(self):
+        data = {
+            'UserName': self._uid,
+            'NickName': self._nickname,
+            'HeadImgUrl': self._head_img_url,
+            'City': self._city,
+        }
+        for name, key in self._NAME_FIELDS:
+            value = getattr(self, name)
+            if value:
+                data[key] = value
+        return data
 
 
 class User(AbstractUser):
 
+    __slots__ = ('_gender', 'signature')
+
     GENDERS = {
         1: '男',
         2: '女',
         3: '未知',
     }
 
-    def __init__(self, initial_data, skey):
+    def __init__(self, initial_data):
         super().__init__(initial_data)
         self._gender = initial_data.get('Sex', 0)
         self.signature = initial_data.get('Signature', '')
@@ -55,18 +107,30 @@ class User(AbstractUser):
     def gender(self):
         return self.GENDERS.get(self._gender, '未知')
 
+    def dump(self):
+        data = super().dump()
+        data['Sex'] = self._gender
+        data['Signature'] = self.signature
+        return data
+
 
 class Friend(User):
     """好友"""
 
+    __slots__ = ()
+
 
 class MP(AbstractUser):
     """公众号"""
 
+    __slots__ = ()
+
 
 class ChatRoom(AbstractUser):
     """群聊"""
 
+    __slots__ = ('_members',)
+
     def __init__(self, initial_data):
         super().__init__(initial_data)
         self._members = {}
@@ -75,10 +139,26 @@ class ChatRoom(AbstractUser):
     def members(self):
         return list(self._members.values())
 
+    @property
+    def member_count(self):
+        return len(self._members)
+
+    def member_uids(self):
+        return self._members.keys()
+
+    def get_member(self, uid):
+        return self._members.get(uid)
+
+    def __contains__(self, uid):
+        return getattr(uid, 'uid', uid) in self._members
+
     def add(self, friend):
         assert isinstance(friend, Friend)
 
-        self._members[friend.id] = friend
+        self._members[friend.uid] = friend
+
+    def remove(self, uid):
+        return self._members.pop(uid, None)
 
 
 special_account_name = (
@@ -103,6 +183,8 @@ class SpecialAccount(AbstractUser):
     wxitil, userexperience_alarm, notification_messages
     """
 
+    __slots__ = ()
+
 
 def create_user(user_info, skey):
     username = user_info.get('UserName', '')
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Running CPU-heavy handlers in a process pool.
+
+The loop thread also drives the sync long-poll, so a handler that spends
+a second in a regex stalls every account in the process. Offloaded
+handlers run in worker processes instead. They get the message rebuilt
+from ``Message.dump()``, with senders and recipients as ContactRef tuples
+rather than the linked user objects, whose chatrooms would drag the whole
+contact graph through pickle.
+
+Every Offloader in a process shares one pool per worker count and start
+method, so dozens of accounts in one process do not each start a pool.
+Pools start their workers with forkserver where available, else spawn:
+forking a process that already runs the loop thread, the I/O pool and the
+history writer would copy their locks in whatever state they are in.
+Workers import the handlers' module afresh, so a script offloading its own
+handlers needs the ``if __name__ == '__main__':`` guard.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import pickle
+import threading
+
+from .exceptions import OffloadOverloadError
+from .models.message import MessageFactory, UnknownMessage
+
+logger = logging.getLogger('sago')
+
+DEFAULT_START_METHOD = ('forkserver' if 'forkserver' in
+                        multiprocessing.get_all_start_methods() else 'spawn')
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(workers=None, start_method=None, broken=None):
+    """The process pool shared by every Offloader of this process with the
+    same ``workers`` and ``start_method``; ``broken``, a pool that failed,
+    is replaced by a new one."""
+    key = (workers, start_method or DEFAULT_START_METHOD)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None or executor is broken:
+            executor = _executors[key] = (
+                concurrent.futures.ProcessPoolExecutor(
+                    workers, multiprocessing.get_context(key[1])))
+    return executor
+
+
+def shutdown_executors(wait=True):
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait)
+
+ContactRef = collections.namedtuple(
+    'ContactRef', ('uid', 'nickname', 'remark_name', 'group'))
+
+
+def contact_ref(user):
+    if isinstance(user, str):
+        return ContactRef(user, '', '', None)
+
+    group = getattr(user.contact_group, 'name', None)
+    return ContactRef(user.uid, user.nickname, user.remark_name, group)
+
+
+def pack_message(message):
+    return (message.dump(), contact_ref(message.from_user),
+            contact_ref(message.to_user), message.skey)
+
+
+def unpack_message(packed):
+    data, from_user, to_user, skey = packed
+    msg_cls = MessageFactory.MESSAGE_TYPES.get(data['MsgType'], UnknownMessage)
+    return msg_cls(data, from_user, to_user, skey)
+
+
+def _run_handler(handler, packed):
+    return handler(unpack_message(packed))
+
+
+class Offloader:
+    """Runs handlers on a process pool, at most ``max_pending`` at a time.
+
+    Messages past that limit are rejected with OffloadOverloadError rather
+    than queued, so a slow handler cannot pile up unbounded work. A call
+    taking longer than ``timeout`` seconds fails with asyncio.TimeoutError;
+    the worker still finishes it, but the result is dropped.
+
+    The pool is the process-wide one of ``get_executor`` unless an
+    ``executor`` is given, which is then left to its owner to shut down.
+    """
+
+    def __init__(self, workers=None, max_pending=100, timeout=30,
+                 start_method=None, executor=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.start_method = start_method
+
+        self._executor = executor
+        self._shared = executor is None
+        self.pending = 0
+        self.overloaded = False
+        self.stats = collections.Counter()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = get_executor(self.workers, self.start_method)
+        return self._executor
+
+    @staticmethod
+    def check(handler):
+        try:
+            pickle.dumps(handler)
+        except (pickle.PicklingError, AttributeError, TypeError) as ex:
+            raise ValueError('Offloaded handler %r cannot be pickled, use a '
+                             'module level function: %s' % (handler, ex))
+
+    def submit(self, fn, *args):
+        """Run ``fn(*args)`` on the pool; returns an asyncio future."""
+        if self.pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            if not self.overloaded:
+                self.overloaded = True
+                logger.warning('Offload pool overloaded, %d calls pending; '
+                               'rejecting new ones.', self.pending)
+            raise OffloadOverloadError(
+                'Too many offloaded calls pending (%d).' % self.pending)
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            if not self._shared:
+                raise
+            logger.warning('Offload pool broken, restarting it.')
+            self._executor = get_executor(
+                self.workers, self.start_method, self._executor)
+            future = self._executor.submit(fn, *args)
+
+        self.pending += 1
+        self.stats['submitted'] += 1
+        future = asyncio.wrap_future(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.pending -= 1
+        if future.cancelled() or future.exception() is not None:
+            self.stats['failed'] += 1
+        else:
+            self.stats['completed'] += 1
+
+        if self.overloaded and self.pending < self.max_pending // 2:
+            self.overloaded = False
+            logger.info('Offload pool recovered, %d calls pending.',
+                        self.pending)
+
+    async def run(self, handler, message):
+        future = self.submit(_run_handler, handler, pack_message(message))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+
+    def shutdown(self):
+        """Stop using the pool, which keeps running for its other users: a
+        given executor is shut down by its owner, the shared ones by
+        ``shutdown_executors``."""
+        if self._shared:
+            self._executor = None
+
+
+class OffloadedHandler:
+
+    def __init__(self, handler, offloader):
+        Offloader.check(handler)
+        self.handler = handler
+        self.offloader = offloader
+
+    def __call__(self, message):
+        return self.offloader.run(self.handler, message)
+
+    def __repr__(self):
+        return '<offloaded %r>' % (self.handler,)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import aiohttp
+
+API_POOL = 'api'
+POLL_POOL = 'poll'
+
+
+class PoolConfig:
+
+    def __init__(self, limit=100, limit_per_host=0, keepalive_timeout=15,
+                 ttl_dns_cache=300, connect_timeout=10, read_timeout=None,
+                 total_timeout=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+
+    def create_connector(self):
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=self.ttl_dns_cache != 0,
+            ttl_dns_cache=self.ttl_dns_cache)
+
+    def create_timeout(self):
+        return aiohttp.ClientTimeout(
+            total=self.total_timeout,
+            connect=self.connect_timeout,
+            sock_read=self.read_timeout)
+
+    def _key(self):
+        return (self.limit, self.limit_per_host, self.keepalive_timeout,
+                self.ttl_dns_cache, self.connect_timeout, self.read_timeout,
+                self.total_timeout)
+
+    def __eq__(self, other):
+        if not isinstance(other, PoolConfig):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return '<PoolConfig limit: %d per host: %d>' % (
+            self.limit, self.limit_per_host)
+
+
+# synccheck is held open by the server for ~25s, so the poll pool has a read
+# timeout above that and a connection slot per account; API requests are
+# short and get a tighter budget.
+DEFAULT_POOL_CONFIGS = {
+    API_POOL: PoolConfig(limit=100, limit_per_host=50, keepalive_timeout=30,
+                         read_timeout=30, total_timeout=60),
+    POLL_POOL: PoolConfig(limit=0, keepalive_timeout=60, read_timeout=40),
+}
+
+_connectors = {}
+
+
+def get_connector(loop, name, config=None):
+    """Return the connector of pool ``name`` shared by every session on
+    ``loop`` with the same ``config``; a Core with a config of its own
+    gets a pool of its own."""
+    config = config or DEFAULT_POOL_CONFIGS[name]
+    key = (loop, name, config)
+    connector = _connectors.get(key)
+    if connector is None or connector.closed:
+        connector = _connectors[key] = config.create_connector()
+
+    return connector
+
+
+def connector_stats(connector):
+    # aiohttp exposes no public counters, these mirror BaseConnector's own
+    # bookkeeping; counters it no longer keeps come out as None.
+    waiters = getattr(connector, '_waiters', None)
+    if isinstance(waiters, dict):
+        waiters = sum(len(w) for w in waiters.values())
+    elif waiters is not None:
+        waiters = len(waiters)
+
+    acquired = getattr(connector, '_acquired', None)
+    conns = getattr(connector, '_conns', None)
+    return {
+        'limit': getattr(connector, 'limit', None),
+        'in_use': len(acquired) if acquired is not None else None,
+        'idle': (sum(len(c) for c in conns.values())
+                 if conns is not None else None),
+        'waiters': waiters,
+    }
+
+
+def pool_stats(loop):
+    """Stats of the pools of ``loop`` by name; further pools of a name,
+    made for other configs, come as ``name#1``, ``name#2``...."""
+    stats = {}
+    for (pool_loop, name, _), connector in _connectors.items():
+        if pool_loop is not loop or connector.closed:
+            continue
+        label, n = name, 0
+        while label in stats:
+            n += 1
+            label = '%s#%d' % (name, n)
+        stats[label] = connector_stats(connector)
+    return stats
+
+
+async def close_pools(loop):
+    """Close every pool of ``loop``, for callers that own the loop and are
+    about to stop it."""
+    for key in [key for key in _connectors if key[0] is loop]:
+        connector = _connectors.pop(key)
+        if not connector.closed:
+            await connector.close()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from .utils.functional import chunked
+
+logger = logging.getLogger('sago')
+
+
+class ContactResolver:
+    """Coalesces lookups of unknown contacts.
+
+    Every key asked for within one loop tick is collected and fetched with a
+    single call of ``fetch``, a coroutine function that takes a list of keys
+    and returns a dict of the values found. Keys already being fetched share
+    the pending future, and keys the server does not know are remembered for
+    ``miss_ttl`` seconds so they are not asked for on every message.
+    """
+
+    def __init__(self, fetch, max_batch=50, miss_ttl=300):
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.miss_ttl = miss_ttl
+
+        self._pending = {}
+        self._inflight = {}
+        self._missing = {}
+        self._scheduled = False
+        self.stats = {'requested': 0, 'batches': 0, 'missing': 0}
+
+    def load(self, key):
+        future = self._pending.get(key) or self._inflight.get(key)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if self._missing.get(key, 0) > time.monotonic():
+            future.set_result(None)
+            return future
+
+        self._pending[key] = future
+        self.stats['requested'] += 1
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._dispatch)
+
+        return future
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def _dispatch(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, {}
+        self._inflight.update(pending)
+
+        loop = asyncio.get_event_loop()
+        for keys in chunked(list(pending), self.max_batch):
+            loop.create_task(self._load_batch(
+                {key: pending[key] for key in keys}))
+
+    async def _load_batch(self, futures):
+        self.stats['batches'] += 1
+        try:
+            found = await self.fetch(list(futures))
+        except Exception as ex:
+            logger.warning('Resolving %d contacts failed: %r',
+                           len(futures), ex)
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        finally:
+            for key in futures:
+                self._inflight.pop(key, None)
+
+        expires_at = time.monotonic() + self.miss_ttl
+        for key, future in futures.items():
+            value = found.get(key)
+            if value is None:
+                self.stats['missing'] += 1
+                self._missing[key] = expires_at
+            if not future.done():
+                future.set_result(value)
+
+    def forget_missing(self):
+        self._missing.clear()
@@ -1,48 +1,138 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import functools
+import logging
 import re
+import resource
+import time
 
+import aiohttp
+
+from .broadcast import BroadcastJob
 from .core import Core
+from .dispatcher import Dispatcher, SPILL
 from .exceptions import LoginTimeoutError
-from .models.contacts import Contacts, ContactGroup
+from .media import MediaFetcher
+from .models.contacts import Contacts, ContactGroup, dump_snapshot
+from .models.message import MessageFactory
 from .models.user import ChatRoom, create_user, Friend, MP, SpecialAccount, User
-from .utils.functional import AsyncObject
+from .offload import Offloader
+from .resolver import ContactResolver
+from .sender import PRIORITY_INTERACTIVE, SendScheduler
+from .session import SessionStore
+from .sync import (
+    Backoff, LOGOUT_RETCODES, RETCODE_OK, SELECTOR_NONE, SyncStats)
+from .utils.functional import AsyncObject, chunked
+
+logger = logging.getLogger('sago')
+
+SYNC_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
 
 
 class BaseSago:
 
-    def __init__(self, nowait=True):
-        self.core = Core()
+    BATCH_CONTACT_SIZE = 50
+    BATCH_CONTACT_CONCURRENCY = 4
+    BATCH_CONTACT_RETRIES = 3
+    BATCH_CONTACT_RETRY_DELAY = 1
+
+    SYNC_ERROR_DELAY = 1
+    SYNC_IDLE_DELAY = 0.5
+    # An empty synccheck is the server's normal long-poll timeout, so the
+    # pause after one stays short however quiet the account is.
+    SYNC_IDLE_MAX_DELAY = 2
+    SYNC_MAX_DELAY = 60
+    SESSION_SAVE_INTERVAL = 60
+    # Contacts are saved at most this often, and only when they changed.
+    CONTACTS_SAVE_INTERVAL = 600
+
+    MEDIA_CONCURRENCY = 4
+
+    # Process pool for handlers registered with offload=True, shared by the
+    # accounts of a process that use the same settings; None workers means
+    # one per CPU.
+    OFFLOAD_WORKERS = None
+    OFFLOAD_MAX_PENDING = 100
+    OFFLOAD_TIMEOUT = 30
+
+    # Seconds a contact resolved on demand stays cached, and an unknown
+    # UserName is not asked for again, in lazy contacts mode.
+    CONTACT_TTL = 3600
+    CONTACT_MISS_TTL = 300
+
+    # Messages per second for the whole account and for a single chat.
+    SEND_RATE = 1
+    SEND_BURST = 5
+    SEND_CHAT_RATE = 0.5
+    SEND_CHAT_BURST = 3
+    SEND_RETRIES = 3
+
+    def __init__(self, nowait=True, queue_size=1000, workers=4,
+                 backpressure=SPILL, session_path=None, core=None, loop=None,
+                 auto_login=True, lazy_contacts=False, history=None,
+                 offloader=None):
+        # With ``loop`` everything runs on the caller's loop: the ``a_*``
+        # coroutines are the API and login is scheduled as a task there.
+        self.core = core or Core(loop=loop)
+        self.async_mode = loop is not None
+        # Fetch contacts when they are first seen in a message instead of
+        # loading the whole account at login.
+        self.lazy_contacts = lazy_contacts
+        # A MessageHistory every incoming message is appended to.
+        self.history = history
+        self.dispatcher = Dispatcher(
+            queue_size, workers, backpressure, offloader or Offloader(
+                self.OFFLOAD_WORKERS, self.OFFLOAD_MAX_PENDING,
+                self.OFFLOAD_TIMEOUT))
+        self.session = SessionStore(session_path) if session_path else None
+        self._media_fetcher = None
+        self.sender = SendScheduler(
+            self._send, self.SEND_RATE, self.SEND_BURST, self.SEND_CHAT_RATE,
+            self.SEND_CHAT_BURST, self.SEND_RETRIES)
 
         self.skey = None
         self.uin = None
         self.pass_ticket = None
         self.sid = None
         self.sync_key = None
+        self.sync_check_key = None
+        self.sync_stats = SyncStats()
         self.user = None
         self.has_logged_in = False
+        self.contact_stats = {}
 
         self.init_contacts()
-        self.f = self.login(nowait=nowait)
+        self.f = self.login(nowait=nowait) if auto_login else None
+
+    def __getattr__(self, name):
+        # Only reached for missing attributes; ``foo`` becomes a sync
+        # wrapper of ``a_foo``, cached on the instance after the first use.
+        if name.startswith('a_') or name.startswith('__'):
+            raise AttributeError(name)
 
-    def __getattribute__(self, name):
         try:
-            return super().__getattribute__(name)
-        except AttributeError as ex:
-            try:
-                a_func = super().__getattribute__('a_' + name)
-                return functools.update_wrapper(
-                    AsyncObject(a_func, self.core.loop), a_func)
-            except AttributeError:
-                raise ex
+            a_func = getattr(self, 'a_' + name)
+        except AttributeError:
+            raise AttributeError(name) from None
+
+        wrapper = functools.update_wrapper(
+            AsyncObject(a_func, self.core.loop), a_func)
+        self.__dict__[name] = wrapper
+        return wrapper
 
     def init_contacts(self):
-        self.contacts = Contacts()
+        self._resolver = None
+        self._saved_contacts_version = None
+        self.contacts = Contacts(
+            self.CONTACT_TTL if self.lazy_contacts else None)
         self.contacts.add('friends', ContactGroup(Friend))
         self.contacts.add('mps', ContactGroup(MP))
         self.contacts.add('chatrooms', ContactGroup(ChatRoom))
         self.contacts.add('special_accounts', ContactGroup(SpecialAccount))
 
+    def on(self, msg_type=None, group=None, chat=None, offload=False):
+        return self.dispatcher.register(msg_type, group, chat, offload)
+
     def run_async(self, method, **kwargs):
         return AsyncObject(method, self.core.loop)(**kwargs)
 
@@ -53,20 +143,36 @@ class BaseSago:
             pass
 
         self.has_logged_in = False
+        self.dispatcher.stop()
+        self.sender.stop()
         self.init_contacts()
 
     def login(self, **kwargs):
         self.logout()
-        self._current_state = self.run_async(self.a_login, **kwargs)
+        if self.async_mode:
+            self._current_state = self.core.loop.create_task(self.a_login())
+        else:
+            self._current_state = self.run_async(self.a_login, **kwargs)
         return self._current_state
 
+    async def a_close(self):
+        if self.has_logged_in and self.session:
+            await self.a_save_session()
+            await self.a_save_contacts()
+        self.logout()
+        if self.dispatcher.offloader is not None:
+            self.dispatcher.offloader.shutdown()
+        await self.core.close()
+
     async def a_login(self):
+        if self.session and await self.a_resume():
+            return
+
         uuid = await self.core.request_uuid()
         if not uuid:
             raise ValueError('Request uuid failed.')
 
-        qrcode_storage = self.get_qrcode_storage()
-        await self.core.get_login_qrcode(uuid, qrcode_storage)
+        await self.a_show_login_qrcode(uuid)
 
         login_confirm_url = await self.a_waiting_login_confirm(uuid)
         ret = await self.core.login_confirm(login_confirm_url)
@@ -83,22 +189,269 @@ class BaseSago:
 
         self.has_logged_in = True
 
-        await self.a_update_all_contacts()
-        await self.a_update_chatrooms_info()
+        if not self.lazy_contacts:
+            await self.a_update_all_contact()
+            await self.a_update_chatrooms_info()
+        await self.a_save_session()
+        await self.a_save_contacts()
+
+    async def a_show_login_qrcode(self, uuid):
+        qrcode_storage = self.get_qrcode_storage()
+        await self.core.get_login_qrcode(uuid, qrcode_storage)
+
+    async def a_resume(self):
+        data = await self.core.loop.run_in_executor(None, self.session.load)
+        if not data:
+            return False
+
+        self.restore_session(data)
+        if 'contacts' not in data:
+            contacts = await self.core.loop.run_in_executor(
+                None, self.session.load_contacts)
+            if contacts:
+                self.restore_contacts(contacts)
+
+        retcode, _ = await self.a_sync_check()
+        if retcode != RETCODE_OK:
+            logger.info('Saved session is no longer valid (retcode %s).',
+                        retcode)
+            self.init_contacts()
+            return False
+
+        self.has_logged_in = True
+        return True
+
+    async def a_save_session(self):
+        if not self.session:
+            return
+
+        data = self.dump_session()
+        return await self.core.loop.run_in_executor(
+            None, self.session.save, data)
+
+    async def a_save_contacts(self):
+        """Save the contacts next to the session. Only the snapshot of
+        references is taken on the loop; dumping and writing them happens
+        in the executor."""
+        if not self.session:
+            return
+
+        version = self.contacts.version
+        snapshot = self.contacts.snapshot()
+        path = await self.core.loop.run_in_executor(
+            None, lambda: self.session.save_contacts(dump_snapshot(snapshot)))
+        self._saved_contacts_version = version
+        return path
+
+    def dump_session(self):
+        # Only what it takes to resume; contacts are saved separately by
+        # a_save_contacts.
+        return {
+            'skey': self.skey,
+            'sid': self.sid,
+            'uin': self.uin,
+            'pass_ticket': self.pass_ticket,
+            'sync_key': self.sync_key,
+            'sync_check_key': self.sync_check_key,
+            'user': self.user.dump() if self.user else None,
+            'cookies': self.core.dump_cookies(),
+        }
+
+    def restore_session(self, data):
+        self.skey = data['skey']
+        self.sid = data['sid']
+        self.uin = data['uin']
+        self.pass_ticket = data['pass_ticket']
+        self.sync_key = data['sync_key']
+        self.sync_check_key = data.get('sync_check_key')
+        if data.get('user'):
+            self.set_user_info(data['user'])
+
+        self.core.load_cookies(data.get('cookies') or ())
+
+        self.init_contacts()
+        add_user = (self.contacts.cache_user if self.lazy_contacts
+                    else self.contacts.add_user)
+        # Sessions saved before contacts had a file of their own.
+        for name, users in data.get('contacts', {}).items():
+            member_type = self.contacts[name].member_type
+            for user_info in users:
+                user_info['skey'] = self.skey
+                user = add_user(member_type(user_info))
+                self.update_chatroom_members(user, user_info)
+
+    def restore_contacts(self, data):
+        self.contacts.load_snapshot(data, self.skey, self.lazy_contacts)
+        self._saved_contacts_version = self.contacts.version
 
     async def a_heart_beat(self):
-        while self.has_logged_in:
-            retcode, selector = await self.core.sync_check(
-                self.skey, self.sid, self.uin, self.sync_key)
-            if selector != '2':
-                continue
+        self.dispatcher.start(self.core.loop)
+        factory = MessageFactory(self.contacts, self.skey)
+        error_backoff = Backoff(self.SYNC_ERROR_DELAY, self.SYNC_MAX_DELAY)
+        idle_backoff = Backoff(self.SYNC_IDLE_DELAY, self.SYNC_IDLE_MAX_DELAY)
+        saved_at = contacts_saved_at = time.monotonic()
+        check = save_contacts = None
 
-            new_data = await self.core.sync_data(
-                self.skey, self.sid, self.uin, self.sync_key, self.pass_ticket)
+        try:
+            while self.has_logged_in:
+                if check is None:
+                    check = self.core.loop.create_task(self.a_sync_check())
+
+                try:
+                    retcode, selector = await check
+                except SYNC_ERRORS as ex:
+                    await self._sync_failed(ex, error_backoff)
+                    continue
+                finally:
+                    check = None
+
+                if retcode in LOGOUT_RETCODES:
+                    self.session_expired(retcode)
+                    break
+
+                if retcode != RETCODE_OK:
+                    await self._sync_failed(
+                        'retcode %s' % retcode, error_backoff)
+                    continue
+
+                self.sync_stats.record_poll(selector)
+                if selector == SELECTOR_NONE:
+                    await asyncio.sleep(idle_backoff.next_delay())
+                    continue
+
+                try:
+                    new_data = await self.core.sync_data(
+                        self.skey, self.sid, self.uin, self.sync_key,
+                        self.pass_ticket)
+                    ret = str(new_data['BaseResponse']['Ret'])
+                except SYNC_ERRORS + (KeyError,) as ex:
+                    await self._sync_failed(ex, error_backoff)
+                    continue
+
+                if ret in LOGOUT_RETCODES:
+                    self.session_expired(ret)
+                    break
+
+                if ret != RETCODE_OK:
+                    await self._sync_failed('sync ret %s' % ret, error_backoff)
+                    continue
+
+                error_backoff.reset()
+                idle_backoff.reset()
+                self.update_sync_key(new_data)
+                self.sync_stats.record_sync(new_data)
+
+                # Poll for the next batch while this one is being processed.
+                check = self.core.loop.create_task(self.a_sync_check())
+                await self.process_sync_data(new_data, factory)
+
+                now = time.monotonic()
+                if now - saved_at > self.SESSION_SAVE_INTERVAL:
+                    saved_at = now
+                    await self.a_save_session()
+
+                if (now - contacts_saved_at > self.CONTACTS_SAVE_INTERVAL and
+                        self.contacts.version !=
+                        self._saved_contacts_version and
+                        (save_contacts is None or save_contacts.done())):
+                    contacts_saved_at = now
+                    save_contacts = self.core.loop.create_task(
+                        self.a_save_contacts())
+                    save_contacts.add_done_callback(self._contacts_saved)
+        finally:
+            if check is not None:
+                check.cancel()
+            if save_contacts is not None:
+                await asyncio.gather(save_contacts, return_exceptions=True)
+
+    @staticmethod
+    def _contacts_saved(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Saving contacts failed: %r', task.exception())
+
+    async def a_sync_check(self):
+        return await self.core.sync_check(
+            self.skey, self.sid, self.uin,
+            self.sync_check_key or self.sync_key)
+
+    async def _sync_failed(self, reason, backoff):
+        self.sync_stats.errors += 1
+        delay = backoff.next_delay()
+        logger.warning('Sync failed (%s), retry in %.1fs.', reason, delay)
+        await asyncio.sleep(delay)
+
+    def update_sync_key(self, sync_data):
+        if sync_data.get('SyncKey', {}).get('Count'):
+            self.sync_key = sync_data['SyncKey']
+        if sync_data.get('SyncCheckKey', {}).get('Count'):
+            self.sync_check_key = sync_data['SyncCheckKey']
+
+    async def process_sync_data(self, sync_data, factory):
+        updated, _ = self.contacts.apply_sync(sync_data, self.skey)
+        for user, user_info in updated:
+            self.update_chatroom_members(user, user_info, notify=True)
+
+        if sync_data.get('AddMsgList'):
+            if self.lazy_contacts:
+                self.contacts.expire()
+                await self.a_resolve_senders(sync_data['AddMsgList'])
+
+            messages = factory.build_all(sync_data['AddMsgList'])
+            if self.history is not None:
+                self.history.append(
+                    messages, self.user.uid if self.user else None)
+            await self.dispatcher.feed(messages)
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            self._resolver = ContactResolver(
+                self._fetch_contacts, self.BATCH_CONTACT_SIZE,
+                self.CONTACT_MISS_TTL)
+
+        return self._resolver
+
+    async def a_resolve(self, *user_id):
+        """Return the users of ``user_id``, fetching unknown ones together
+        with every other lookup made in the same loop tick."""
+        return await asyncio.gather(
+            *[self._resolve_one(uid) for uid in user_id])
+
+    async def _resolve_one(self, uid):
+        user = self.contacts.get_user(uid)
+        if user is None:
+            user = await self.resolver.load(uid)
+        return user
+
+    async def a_resolve_senders(self, msg_list):
+        own_uid = self.user.uid if self.user else None
+        get_user = self.contacts.get_user
+        unknown = {uid for d in msg_list
+                   for uid in (d['FromUserName'], d['ToUserName'])
+                   if uid != own_uid and get_user(uid) is None}
+        if not unknown:
+            return
+
+        results = await asyncio.gather(
+            *[self.resolver.load(uid) for uid in unknown],
+            return_exceptions=True)
+        failed = sum(isinstance(ret, Exception) for ret in results)
+        if failed:
+            logger.warning('Could not resolve %d of %d contacts.',
+                           failed, len(unknown))
+
+    async def _fetch_contacts(self, user_ids):
+        contact_data = await self.core.batch_get_contact(
+            self.skey, self.sid, self.uin, self.pass_ticket, *user_ids)
 
-            if new_data.get('AddMsgList'):
-                for msg_data in new_data['AddMsgList']:
-                    pass
+        users = {}
+        for user_info in contact_data:
+            user = create_user(user_info, self.skey)
+            user = user and self.contacts.cache_user(user)
+            if user:
+                self.update_chatroom_members(user, user_info)
+                users[user.uid] = user
+        return users
 
     async def a_waiting_login_confirm(self, uuid):
         tip = 1
@@ -120,44 +473,151 @@ class BaseSago:
                 return self.login()
 
     async def a_update_contacts(self, *user_id):
-        contact_data = await self.core.batch_get_contact(
-            self.skey, self.sid, self.uin, self.pass_ticket, *user_id)
-
-        for user_info in contact_data:
-            user = self.contacts.search(user_info['UserName'])
-            new_user = create_user(user_info, self.skey)
-            user.contact_group.add(new_user)
-            del user
-
-            if isinstance(new_user, ChatRoom):
-                for member_data in user_info['MemberList']:
-                    member = self.contacts.get(member_data['UserName'])
-                    if not member:
-                        member = create_user(member_data, self.skey)
+        semaphore = asyncio.Semaphore(self.BATCH_CONTACT_CONCURRENCY)
+        chunks = chunked(user_id, self.BATCH_CONTACT_SIZE)
+        results = await asyncio.gather(
+            *[self._update_contacts_chunk(chunk, semaphore)
+              for chunk in chunks],
+            return_exceptions=True)
+
+        failed = []
+        for chunk, ret in zip(chunks, results):
+            if isinstance(ret, Exception):
+                logger.error('Failed to fetch %d contacts: %r',
+                             len(chunk), ret)
+                failed.extend(chunk)
+
+        return failed
+
+    async def _update_contacts_chunk(self, user_ids, semaphore):
+        for attempt in range(1, self.BATCH_CONTACT_RETRIES + 1):
+            try:
+                async with semaphore:
+                    contact_data = await self.core.batch_get_contact(
+                        self.skey, self.sid, self.uin, self.pass_ticket,
+                        *user_ids)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    KeyError, ValueError) as ex:
+                if attempt == self.BATCH_CONTACT_RETRIES:
+                    raise
+
+                logger.warning('Fetching contacts failed (%r), retry %d/%d.',
+                               ex, attempt, self.BATCH_CONTACT_RETRIES)
+                await asyncio.sleep(self.BATCH_CONTACT_RETRY_DELAY * attempt)
+                continue
 
-                    new_user.add(member)
+            for user_info in contact_data:
+                new_user = create_user(user_info, self.skey)
+                new_user = new_user and self.contacts.add_user(new_user)
+                if new_user:
+                    self.update_chatroom_members(new_user, user_info)
+            return
+
+    def update_chatroom_members(self, chatroom, user_info, notify=False):
+        # A chatroom always has at least ourselves in it, an empty
+        # MemberList only means the payload carries no members.
+        member_list = user_info.get('MemberList')
+        if not isinstance(chatroom, ChatRoom) or not member_list:
+            return
+
+        known = chatroom.member_count > 0
+        members = []
+        for member_data in member_list:
+            member = self.contacts.get_or_create_member(
+                member_data, self.skey)
+            if member:
+                members.append(member)
+
+        joined, left = self.contacts.set_members(chatroom, members)
+        if notify and known:
+            if joined:
+                self.member_joined(chatroom, joined)
+            if left:
+                self.member_left(chatroom, left)
 
     async def a_update_chatrooms_info(self):
         await self.a_update_contacts(
-            *[u.id for u in self.contacts.chatrooms.members])
+            *[u.uid for u in self.contacts.chatrooms.members])
 
     async def a_update_all_contact(self):
-        contact_data = await self.core.request_all_contact(
-            self.skey, self.pass_ticket)
-
-        for user_info in contact_data:
-            user_info['skey'] = self.skey
-            user = create_user(user_info)
-            self.contacts.add_user(user)
+        started_at = time.monotonic()
+        first_contact_at = None
+        count = 0
+
+        async for user_info in self.core.iter_all_contact(
+                self.skey, self.pass_ticket):
+            user = create_user(user_info, self.skey)
+            if user:
+                self.contacts.add_user(user)
+                count += 1
+                if first_contact_at is None:
+                    first_contact_at = time.monotonic()
+
+        self.contact_stats = {
+            'count': count,
+            'elapsed': time.monotonic() - started_at,
+            'time_to_first_contact': (
+                first_contact_at - started_at if first_contact_at else None),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        logger.info('Loaded %(count)d contacts in %(elapsed).2fs, first '
+                    'after %(time_to_first_contact)ss, peak rss '
+                    '%(peak_rss_kb)d KB', self.contact_stats)
+
+    async def a_send_text(self, to_user, text, priority=PRIORITY_INTERACTIVE):
+        to_user = getattr(to_user, 'uid', to_user)
+        return await self.sender.submit(to_user, text, 1, priority)
+
+    async def a_broadcast(self, selector, text, checkpoint_path, **kwargs):
+        job = BroadcastJob(self, selector, text, checkpoint_path, **kwargs)
+        await job.run()
+        return job
+
+    async def _send(self, to_user, content, msg_type, local_id):
+        return await self.core.send_msg(
+            self.skey, self.sid, self.uin, self.pass_ticket, self.user.uid,
+            to_user, content, msg_type, local_id)
 
     def qrcode_scanned(self):
         return
 
+    def session_expired(self, retcode):
+        logger.warning('Session expired: %s.',
+                       LOGOUT_RETCODES.get(retcode, retcode))
+        self.has_logged_in = False
+
+    def member_joined(self, chatroom, members):
+        return
+
+    def member_left(self, chatroom, members):
+        return
+
     def login_timeout(self):
         raise LoginTimeoutError('Login timeout.')
 
     def get_qrcode_storage(self):
         return
 
+    def get_media_storage(self):
+        return
+
+    @property
+    def media_fetcher(self):
+        if self._media_fetcher is None:
+            storage = self.get_media_storage()
+            if storage is None:
+                raise ValueError('get_media_storage() returned no storage.')
+
+            self._media_fetcher = MediaFetcher(
+                self.core, storage, self.MEDIA_CONCURRENCY)
+
+        return self._media_fetcher
+
+    async def a_download_media(self, message, thumb=False):
+        return await self.media_fetcher.fetch(message, thumb)
+
+    async def a_download_all_media(self, messages):
+        return await self.media_fetcher.fetch_all(messages)
+
     def set_user_info(self, user_info):
         self.user = User(user_info)
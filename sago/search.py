@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Full-text search over the message history.
+
+Text is split into words for Latin scripts, and CJK is indexed both by
+character and by overlapping character bigrams, which needs no dictionary:
+a one character query looks the character up, a longer one ANDs its
+bigrams. Bigrams do not have to be adjacent to match, so hits for three or
+more CJK characters are checked against the text when the index has a
+``texts`` source. Every term has a posting list of (document, term
+frequency) pairs, stored as varint deltas in blocks of ``BLOCK_SIZE``
+entries. The first document of every block is kept aside, so intersecting
+a rare term with a common one decodes only the blocks that can hold the
+rare term's documents.
+
+Documents are the history rows; the index is fed by MessageHistory after
+each commit and can be rebuilt from it at any time.
+"""
+import array
+import bisect
+import collections
+import heapq
+import html
+import math
+import re
+import threading
+
+BLOCK_SIZE = 128
+
+INDEXED_TYPES = frozenset((1,))
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_TOKEN_RE = re.compile(r'([%s]+)|([^\W%s_]+)' % (_CJK, _CJK))
+_TAG_RE = re.compile(r'<[^>]*>')
+
+
+def tokenize(text):
+    """The terms ``text`` is indexed under."""
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text):
+        if cjk:
+            tokens.extend(cjk)
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def query_terms(text):
+    """The terms to look ``text`` up by, and the CJK runs of three or more
+    characters a hit must contain as they are."""
+    terms, phrases = [], []
+    for cjk, word in _TOKEN_RE.findall(text):
+        if not cjk:
+            terms.append(word.lower())
+        elif len(cjk) == 1:
+            terms.append(cjk)
+        else:
+            terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            if len(cjk) > 2:
+                phrases.append(cjk)
+    return terms, phrases
+
+
+def clean_text(content):
+    """The plain text of a message, without markup such as emoji spans."""
+    return html.unescape(_TAG_RE.sub(' ', content.replace('<br/>', '\n')))
+
+
+def _put_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _decode_block(data, doc):
+    entries = []
+    append = entries.append
+    i, n = 0, len(data)
+    while i < n:
+        delta = data[i]
+        i += 1
+        if delta >= 0x80:
+            delta &= 0x7f
+            shift = 7
+            while True:
+                b = data[i]
+                i += 1
+                delta |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+        doc += delta
+        append((doc, data[i]))
+        i += 1
+    return entries
+
+
+class PostingList:
+
+    __slots__ = ('starts', 'blocks', 'tail', 'tail_count', 'last', 'count')
+
+    def __init__(self):
+        self.starts = array.array('l')
+        self.blocks = []
+        self.tail = bytearray()
+        self.tail_count = 0
+        self.last = 0
+        self.count = 0
+
+    def add(self, doc, tf):
+        if self.tail_count == BLOCK_SIZE:
+            self.blocks.append(bytes(self.tail))
+            self.tail = bytearray()
+            self.tail_count = 0
+        if self.tail_count == 0:
+            self.starts.append(doc)
+            self.last = doc
+
+        _put_varint(self.tail, doc - self.last)
+        self.tail.append(min(tf, 255))
+        self.last = doc
+        self.tail_count += 1
+        self.count += 1
+
+    def block(self, i):
+        data = self.blocks[i] if i < len(self.blocks) else self.tail
+        return _decode_block(data, self.starts[i])
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield from self.block(i)
+
+    def lookup(self, docs):
+        """Term frequencies of those of the sorted ``docs`` in the list."""
+        found = {}
+        starts = self.starts
+        decoded = None
+        current = -1
+        for doc in docs:
+            i = bisect.bisect_right(starts, doc) - 1
+            if i < 0:
+                continue
+            if i != current:
+                current = i
+                decoded = dict(self.block(i))
+            tf = decoded.get(doc)
+            if tf is not None:
+                found[doc] = tf
+        return found
+
+    def nbytes(self):
+        return (sum(len(b) for b in self.blocks) + len(self.tail) +
+                self.starts.itemsize * len(self.starts))
+
+
+class SearchIndex:
+    """An in-memory inverted index of message text.
+
+    Documents are numbered in the order they are added; ``ids`` maps them
+    back to history row ids, which only ever grow. ``texts``, if given,
+    takes a list of row ids and returns a dict of their contents, used to
+    check phrase hits; MessageHistory sets it to read its own rows.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, texts=None):
+        self.texts = texts
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.ids = array.array('q')
+        self.chats = array.array('l')
+        self.senders = array.array('l')
+        self.times = array.array('q')
+        self.lengths = array.array('l')
+        self._names = {}
+        self._name_list = []
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _name_id(self, name):
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = self._names[name] = len(self._name_list)
+            self._name_list.append(name)
+        return name_id
+
+    def add(self, record):
+        """Index a history record, a dict with ``id``, ``msg_type``,
+        ``chat``, ``sender``, ``create_time`` and ``content``."""
+        if record['msg_type'] not in INDEXED_TYPES:
+            return False
+
+        with self._lock:
+            return self._add(record)
+
+    def add_all(self, records):
+        with self._lock:
+            return sum(self._add(r) for r in records
+                       if r['msg_type'] in INDEXED_TYPES)
+
+    def _add(self, record):
+        if self.ids and record['id'] <= self.ids[-1]:
+            return False
+
+        tokens = tokenize(clean_text(record['content']))
+        if not tokens:
+            return False
+
+        doc = len(self.ids)
+        self.ids.append(record['id'])
+        self.chats.append(self._name_id(record['chat']))
+        self.senders.append(self._name_id(record['sender']))
+        self.times.append(record['create_time'])
+        self.lengths.append(len(tokens))
+        self._total_length += len(tokens)
+
+        postings = self.postings
+        for term, tf in collections.Counter(tokens).items():
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = PostingList()
+            posting.add(doc, tf)
+        return True
+
+    def rebuild(self, history, batch_size=5000):
+        """Index everything stored in ``history`` from scratch."""
+        with self._lock:
+            self.clear()
+            return sum(self._add(r) for r in history.iter_all(batch_size)
+                       if r['msg_type'] in INDEXED_TYPES)
+
+    def search(self, query, chat=None, sender=None, since=None, until=None,
+               limit=20):
+        """History row ids of the messages containing every term of
+        ``query``, best match first, as ``(id, score)`` pairs."""
+        terms, phrases = query_terms(clean_text(query))
+        if not terms:
+            return []
+        if not phrases or self.texts is None:
+            with self._lock:
+                return self._search(set(terms), chat, sender, since, until,
+                                    limit)
+
+        # Every candidate, best first, checked in pages until enough match.
+        with self._lock:
+            ranked = self._search(set(terms), chat, sender, since, until,
+                                  None)
+        hits = []
+        for i in range(0, len(ranked), limit * 2):
+            page = ranked[i:i + limit * 2]
+            texts = self.texts([row_id for row_id, _ in page])
+            for row_id, score in page:
+                text = clean_text(texts.get(row_id, ''))
+                if all(phrase in text for phrase in phrases):
+                    hits.append((row_id, score))
+                    if len(hits) == limit:
+                        return hits
+        return hits
+
+    def _search(self, terms, chat, sender, since, until, limit):
+        lists = [self.postings.get(term) for term in terms]
+        if not all(lists):
+            return []
+        lists.sort(key=lambda p: p.count)
+
+        accept = self._filter(chat, sender, since, until)
+        if accept is False:
+            return []
+
+        first = lists[0]
+        if accept is None:
+            docs = list(first)
+        else:
+            docs = [(doc, tf) for doc, tf in first if accept(doc)]
+
+        # Term frequencies of every term, for the documents having them all.
+        found = []
+        for posting in lists[1:]:
+            if not docs:
+                return []
+            tfs = posting.lookup([doc for doc, _ in docs])
+            docs = [item for item in docs if item[0] in tfs]
+            found.append(tfs)
+
+        # BM25. A message has few distinct term frequencies and lengths,
+        # so the per-term factor is computed once per (tf, length).
+        total = len(self.ids)
+        avg_length = self._total_length / total
+        k1, b, lengths = self.K1, self.B, self.lengths
+        idfs = [math.log(1 + (total - p.count + 0.5) / (p.count + 0.5))
+                for p in lists]
+        factors = {}
+
+        def factor(tf, length):
+            key = (tf, length)
+            value = factors.get(key)
+            if value is None:
+                value = factors[key] = tf * (k1 + 1) / (
+                    tf + k1 * (1 - b + b * length / avg_length))
+            return value
+
+        first_idf = idfs[0]
+        rest = list(zip(idfs[1:], found))
+        scored = []
+        for doc, tf in docs:
+            length = lengths[doc]
+            score = first_idf * (factors.get((tf, length)) or
+                                 factor(tf, length))
+            for idf, tfs in rest:
+                score += idf * factor(tfs[doc], length)
+            scored.append((score, doc))
+
+        # Newer messages win ties.
+        if limit is None:
+            best = sorted(scored, reverse=True)
+        else:
+            best = heapq.nlargest(limit, scored)
+        return [(self.ids[doc], score) for score, doc in best]
+
+    def _filter(self, chat, sender, since, until):
+        checks = []
+        if chat is not None:
+            chat_id = self._names.get(chat)
+            if chat_id is None:
+                return False
+            chats = self.chats
+            checks.append(lambda doc: chats[doc] == chat_id)
+        if sender is not None:
+            sender_id = self._names.get(sender)
+            if sender_id is None:
+                return False
+            senders = self.senders
+            checks.append(lambda doc: senders[doc] == sender_id)
+        if since is not None or until is not None:
+            low = since if since is not None else -1 << 62
+            high = until if until is not None else 1 << 62
+            times = self.times
+            checks.append(lambda doc: low <= times[doc] < high)
+
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda doc: all(check(doc) for check in checks)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'documents': len(self.ids),
+                'terms': len(self.postings),
+                'posting_bytes': sum(p.nbytes()
+                                     for p in self.postings.values()),
+            }
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import aiohttp
+
+from .core import new_local_id
+from .exceptions import SendCancelledError, SendMessageError
+
+logger = logging.getLogger('sago')
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BULK = 10
+
+SEND_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError,
+               SendMessageError)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self):
+        """Seconds until a token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+
+    __slots__ = ('to_user', 'content', 'msg_type', 'priority', 'future',
+                 'attempts', 'seq', 'local_id')
+
+    def __init__(self, to_user, content, msg_type, priority, future, seq):
+        self.to_user = to_user
+        self.content = content
+        self.msg_type = msg_type
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+        # Kept through parking and retries, so a message never falls behind
+        # ones queued after it.
+        self.seq = seq
+        # Sent with every attempt, so a retry of a message the server did
+        # get is not delivered twice.
+        self.local_id = new_local_id()
+
+
+class SendScheduler:
+    """Sends queued messages in priority order under an account-wide and a
+    per-chat token bucket.
+
+    Every chat is a FIFO: only its oldest message competes for the account
+    bucket, and the next one waits until that has been delivered or has
+    failed, so a chat sees its messages in order and never two at once. A
+    chat that is out of tokens, or waiting to retry, is parked without
+    holding back other chats.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, send, rate=1, burst=5, chat_rate=0.5, chat_burst=3,
+                 retries=3, retry_delay=1):
+        self._send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._bucket = TokenBucket(rate, burst)
+        self._chat_buckets = {}
+        # to_user -> its messages not yet done, the first one being in
+        # ``_queue``, in ``_parked`` or in flight.
+        self._chats = {}
+        self._queue = []
+        self._parked = []
+        self._inflight = set()
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._loop = None
+
+        self.stats = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0,
+                      'cancelled': 0}
+
+    def start(self, loop=None):
+        if self._task is not None:
+            return
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def stop(self):
+        """Stop sending. Queued messages fail with SendCancelledError, as
+        they are addressed by UserNames of this web session; ones already
+        in flight still complete."""
+        if self._task is not None:
+            self._loop.call_soon_threadsafe(self._stop, self._task)
+            self._task = None
+
+    def _stop(self, task):
+        task.cancel()
+        chats, self._chats = self._chats, {}
+        self._queue = []
+        self._parked = []
+        for chat in chats.values():
+            for msg in chat:
+                if msg in self._inflight or msg.future.done():
+                    continue
+                msg.future.set_exception(SendCancelledError())
+                self.stats['cancelled'] += 1
+
+    def qsize(self):
+        return sum(len(chat) for chat in self._chats.values())
+
+    def submit(self, to_user, content, msg_type=1, priority=PRIORITY_NORMAL):
+        """Queue a message; the returned future resolves to the server's
+        ``{'MsgID': ..., 'LocalID': ...}`` acknowledgement."""
+        self.start()
+        future = self._loop.create_future()
+        msg = OutgoingMessage(to_user, content, msg_type, priority, future,
+                              next(self._counter))
+        chat = self._chats.get(to_user)
+        if chat is None:
+            chat = self._chats[to_user] = collections.deque()
+        chat.append(msg)
+        if len(chat) == 1:
+            self._push(msg)
+        self.stats['queued'] += 1
+        return future
+
+    def _push(self, msg):
+        heapq.heappush(self._queue, (msg.priority, msg.seq, msg))
+        self._wakeup.set()
+
+    def _park(self, msg, delay):
+        heapq.heappush(self._parked, (
+            time.monotonic() + delay, msg.seq, msg))
+        self._wakeup.set()
+
+    def _is_head(self, msg):
+        chat = self._chats.get(msg.to_user)
+        return bool(chat) and chat[0] is msg
+
+    def _done(self, msg):
+        """Let the next message of ``msg``'s chat go."""
+        if not self._is_head(msg):
+            return
+        chat = self._chats[msg.to_user]
+        chat.popleft()
+        if chat:
+            self._push(chat[0])
+        else:
+            del self._chats[msg.to_user]
+
+    def _chat_bucket(self, to_user):
+        bucket = self._chat_buckets.get(to_user)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._chat_buckets = {k: b for k, b in
+                                      self._chat_buckets.items()
+                                      if not b.idle}
+            bucket = self._chat_buckets[to_user] = TokenBucket(
+                self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _unpark(self):
+        now = time.monotonic()
+        while self._parked and self._parked[0][0] <= now:
+            _, _, msg = heapq.heappop(self._parked)
+            self._push(msg)
+
+    def _next_wakeup(self):
+        if self._parked:
+            return max(0, self._parked[0][0] - time.monotonic())
+
+    async def _run(self):
+        while True:
+            self._unpark()
+            if not self._queue:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), self._next_wakeup())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, msg = heapq.heappop(self._queue)
+            if msg.future.cancelled():
+                self._done(msg)
+                continue
+
+            chat_bucket = self._chat_bucket(msg.to_user)
+            chat_delay = chat_bucket.delay()
+            if chat_delay:
+                self._park(msg, chat_delay)
+                continue
+
+            delay = self._bucket.delay()
+            if delay:
+                # Back in with its own sequence number, still first in line.
+                self._push(msg)
+                await asyncio.sleep(delay)
+                continue
+
+            self._bucket.consume()
+            chat_bucket.consume()
+            self._loop.create_task(self._deliver(msg))
+
+    async def _deliver(self, msg):
+        msg.attempts += 1
+        self._inflight.add(msg)
+        try:
+            ack = await self._send(msg.to_user, msg.content, msg.msg_type,
+                                   msg.local_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            if not isinstance(ex, SEND_ERRORS):
+                logger.exception('Unexpected error sending to %s.',
+                                 msg.to_user)
+            # Not retried once the scheduler has been stopped.
+            if msg.attempts >= self.retries or not self._is_head(msg):
+                self.stats['failed'] += 1
+                if not msg.future.done():
+                    msg.future.set_exception(ex)
+                self._done(msg)
+                return
+
+            self.stats['retried'] += 1
+            delay = self.retry_delay * 2 ** (msg.attempts - 1)
+            delay *= random.uniform(0.5, 1.5)
+            logger.warning('Sending to %s failed (%r), retry in %.1fs.',
+                           msg.to_user, ex, delay)
+            self._park(msg, delay)
+            return
+        finally:
+            self._inflight.discard(msg)
+
+        self.stats['sent'] += 1
+        if not msg.future.done():
+            msg.future.set_result(ack)
+        self._done(msg)
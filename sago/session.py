@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import tempfile
+
+from . import codec
+
+logger = logging.getLogger('sago')
+
+
+class SessionStore:
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        # Contacts go to a file of their own: they are large and only
+        # change now and then, while the session changes every sync.
+        self.contacts_path = os.path.splitext(self.path)[0] + '.contacts.json'
+
+    def save(self, data):
+        return self._write(self.path, json.dumps(
+            data, ensure_ascii=False).encode('utf-8'))
+
+    def save_contacts(self, data):
+        return self._write(self.contacts_path, codec.dumps(data))
+
+    def _write(self, path, content):
+        dir_name = os.path.dirname(path)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return path
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning('Session file %s is corrupted, ignored.', self.path)
+            return
+
+    def load_contacts(self):
+        try:
+            with open(self.contacts_path, 'rb') as f:
+                return codec.loads(f.read())
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning('Contacts file %s is corrupted, ignored.',
+                           self.contacts_path)
+            return
+
+    def clear(self):
+        for path in (self.path, self.contacts_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -1,14 +1,68 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import os
+import tempfile
+import threading
 
 from .utils.functional import random_str
 
+IO_WORKERS = 4
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def get_io_executor():
+    """The thread pool storage I/O runs on, kept apart from the loop's
+    default executor so slow disks cannot starve other blocking calls."""
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=IO_WORKERS, thread_name_prefix='sago-io')
+
+    return _io_executor
+
+
+def run_io(fn, *args):
+    return asyncio.get_event_loop().run_in_executor(
+        get_io_executor(), functools.partial(fn, *args))
+
 
 class BaseStorage:
 
     def save(self, *args, **kwargs):
         pass
 
+    async def a_save(self, *args, **kwargs):
+        return await run_io(functools.partial(self.save, *args, **kwargs))
+
+    async def a_open(self, name):
+        """For storages with an ``open(name)`` returning a writable binary
+        file whose ``close()`` returns where the data ended up."""
+        return AsyncStorageFile(await run_io(self.open, name))
+
+
+class AsyncStorageFile:
+
+    def __init__(self, f):
+        self._file = f
+
+    async def write(self, data):
+        # bytes and memoryviews are handed to the I/O thread as they are,
+        # without being joined or copied.
+        return await run_io(self._file.write, data)
+
+    async def close(self):
+        return await run_io(self._file.close)
+
+    async def discard(self):
+        return await run_io(self._file.discard)
+
 
 class TmpFileStorage(BaseStorage):
 
@@ -25,7 +79,143 @@ class TmpFileStorage(BaseStorage):
         self.file_path = os.path.join(abs_path, file_name)
 
     def save(self, buff):
-        with open(self.file_path, 'wb') as f:
-            f.write(buff.getvalue())
+        with open(self.file_path, 'wb') as f, buff.getbuffer() as view:
+            f.write(view)
 
         return self.file_path
+
+
+class StorageFile:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        return self.path
+
+    def discard(self):
+        self._file.close()
+        os.unlink(self.path)
+
+
+class FileSystemStorage(BaseStorage):
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.normpath(path))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def open(self, name):
+        return StorageFile(os.path.join(self.path, name))
+
+
+class ContentAddressedFile(StorageFile):
+
+    def __init__(self, cache, ext):
+        fd, path = tempfile.mkstemp(dir=cache.tmp_path)
+        os.close(fd)
+        super().__init__(path)
+
+        self._cache = cache
+        self._ext = ext
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self._size += len(data)
+        return super().write(data)
+
+    def close(self):
+        self._file.close()
+        return self._cache.commit(
+            self.path, self._hash.hexdigest() + self._ext, self._size)
+
+
+class ContentAddressedCache(BaseStorage):
+    """Stores blobs under their sha256, so identical images, emoticons and
+    avatars are kept once, and evicts the least recently used blobs once
+    the cache grows beyond ``max_bytes``."""
+
+    def __init__(self, path, max_bytes=512 * 2 ** 20):
+        self.path = os.path.abspath(os.path.normpath(path))
+        self.tmp_path = os.path.join(self.path, 'tmp')
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+        if not os.path.exists(self.tmp_path):
+            os.makedirs(self.tmp_path)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for dir_entry in os.scandir(self.path):
+            if not dir_entry.is_dir() or dir_entry.name == 'tmp':
+                continue
+            for f in os.scandir(dir_entry.path):
+                stat = f.stat()
+                entries.append((stat.st_atime, f.name, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def _key_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def open(self, name):
+        return ContentAddressedFile(self, os.path.splitext(name)[1])
+
+    def save(self, buff):
+        f = self.open('')
+        with buff.getbuffer() as view:
+            f.write(view)
+        return f.close()
+
+    def commit(self, tmp_path, key, size):
+        path = self._key_path(key)
+        with self._lock:
+            if key in self._entries:
+                os.unlink(tmp_path)
+                self._entries.move_to_end(key)
+                return path
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self._entries[key] = size
+            self.size += size
+            self._evict()
+
+        return path
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries.move_to_end(key)
+
+        return self._key_path(key)
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(self._key_path(key))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<ContentAddressedCache %s entries: %d bytes: %d>' % (
+            self.path, len(self._entries), self.size)
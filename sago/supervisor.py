@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""Spreading accounts over worker processes.
+
+One process runs one event loop, so it uses one core however many accounts
+it holds. The Supervisor splits the accounts into shards, one per worker
+process. Each worker runs its shard in async mode on its own loop, with a
+Core and a session file per account. A worker that dies is started again
+after a backoff, and its accounts resume from their saved sessions.
+
+Workers and supervisor talk over one pipe per worker, watched by the
+loops' readers rather than by threads. Incoming messages are sent up in
+batches, one per loop tick, as the compact form the offload pool uses.
+Send commands and stats requests go down the pipe, and their answers come
+back tagged with the request id.
+
+    python -m sago.supervisor --workers 4 --session-dir sessions \\
+        mybot:Bot alice bob carol
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from .core import Core
+from .exceptions import WorkerError
+from .offload import pack_message, shutdown_executors, unpack_message
+from .pool import close_pools
+from .sync import Backoff
+
+logger = logging.getLogger('sago')
+
+_STOP = object()
+
+
+def assign_shards(accounts, shards):
+    """Deal ``accounts`` round-robin over ``shards`` lists, in sorted order
+    so that a restart gives every worker the same accounts."""
+    assigned = [[] for _ in range(shards)]
+    for i, name in enumerate(sorted(set(accounts))):
+        assigned[i % shards].append(name)
+    return assigned
+
+
+def account_stats(sago):
+    return {
+        'logged_in': sago.has_logged_in,
+        'contacts': sago.contacts.count,
+        'sync': sago.sync_stats.as_dict(),
+        'dispatcher': dict(sago.dispatcher.stats),
+        'sender': dict(sago.sender.stats),
+    }
+
+
+class PipeSender:
+    """Sends on a Connection from a thread of its own.
+
+    Connection.send blocks once the pipe is full. Called on the loop, it
+    would stop the loop from reading the other direction, and with both
+    ends doing so neither pipe would ever drain. Here only this thread
+    waits, frames still go out in order, and ``on_error`` is called from
+    the thread if the other end is gone.
+    """
+
+    def __init__(self, conn, on_error=None):
+        self.conn = conn
+        self.on_error = on_error
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name='sago-pipe', daemon=True)
+        self._thread.start()
+
+    def send(self, data):
+        self._queue.put(data)
+
+    def close(self, timeout=None):
+        """Stop once what is queued has been sent, waiting up to
+        ``timeout`` seconds for it if it is not None."""
+        self._queue.put(_STOP)
+        if timeout is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is _STOP:
+                return
+            try:
+                self.conn.send(data)
+            except (BrokenPipeError, OSError):
+                if self.on_error is not None:
+                    self.on_error()
+                return
+
+
+class Worker:
+    """The side of a worker process: runs its accounts and answers the
+    supervisor's commands."""
+
+    # Seconds left to send the last frames after stopping.
+    SEND_TIMEOUT = 5
+
+    def __init__(self, index, accounts, sago_class, sago_kwargs, core_kwargs,
+                 session_dir, conn):
+        self.index = index
+        self.account_names = accounts
+        self.sago_class = sago_class
+        self.sago_kwargs = sago_kwargs
+        self.core_kwargs = core_kwargs
+        self.session_dir = session_dir
+        self.conn = conn
+
+        self.loop = None
+        self.sender = None
+        self.accounts = {}
+        self._tasks = {}
+        self._outbox = []
+        self._stopped = None
+
+    def run(self):
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stopped = loop.create_future()
+        self.sender = PipeSender(
+            self.conn, lambda: loop.call_soon_threadsafe(self.stop))
+        loop.add_reader(self.conn.fileno(), self._on_command)
+        for name in self.account_names:
+            self.start_account(name)
+
+        try:
+            loop.run_until_complete(self._stopped)
+            loop.run_until_complete(self._shutdown())
+        finally:
+            self.sender.close(self.SEND_TIMEOUT)
+            loop.close()
+
+    def start_account(self, name):
+        core = Core(loop=self.loop, **self.core_kwargs)
+        sago = self.sago_class(
+            loop=self.loop, core=core,
+            session_path=os.path.join(self.session_dir, name + '.json'),
+            **self.sago_kwargs)
+        sago.on()(functools.partial(self._forward, name))
+        self.accounts[name] = sago
+        self._tasks[name] = self.loop.create_task(
+            self._run_account(name, sago))
+
+    async def _run_account(self, name, sago):
+        try:
+            await sago.f
+            self._send(('status', name, 'online'))
+            await sago.a_heart_beat()
+            self._send(('status', name, 'offline'))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            logger.exception('Account %s failed.', name)
+            self._send(('status', name, 'failed: %r' % ex))
+
+    def _send(self, data):
+        self.sender.send(data)
+
+    def _forward(self, name, message):
+        if not self._outbox:
+            self.loop.call_soon(self._flush)
+        self._outbox.append((name, pack_message(message)))
+
+    def _flush(self):
+        outbox, self._outbox = self._outbox, []
+        self._send(('messages', outbox))
+
+    def _on_command(self):
+        while self.conn.poll():
+            try:
+                command = self.conn.recv()
+            except EOFError:
+                # The supervisor is gone.
+                self.stop()
+                return
+
+            kind = command[0]
+            if kind == 'send':
+                self.loop.create_task(self._send_text(*command[1:]))
+            elif kind == 'stats':
+                self._send(('result', command[1], True, {
+                    'pid': os.getpid(),
+                    'accounts': {name: account_stats(sago)
+                                 for name, sago in self.accounts.items()},
+                }))
+            elif kind == 'stop':
+                self.stop()
+
+    async def _send_text(self, request_id, name, to_user, text):
+        try:
+            ret = await self.accounts[name].a_send_text(to_user, text)
+        except Exception as ex:
+            self._send(('result', request_id, False, repr(ex)))
+        else:
+            self._send(('result', request_id, True, ret))
+
+    def stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    async def _shutdown(self):
+        self.loop.remove_reader(self.conn.fileno())
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        for sago in self.accounts.values():
+            # Saves the session and contacts of a logged in account.
+            await sago.a_close()
+        await close_pools(self.loop)
+        shutdown_executors(wait=False)
+
+
+def run_worker(*args):
+    logging.basicConfig(level=logging.INFO)
+    # Stopping is the supervisor's call.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Worker(*args).run()
+
+
+class WorkerProcess:
+
+    def __init__(self, index, accounts):
+        self.index = index
+        self.accounts = accounts
+        self.process = None
+        self.conn = None
+        self.sender = None
+        self.started_at = None
+        self.restarts = 0
+        self.backoff = None
+
+
+class Supervisor:
+    """Runs ``accounts``, a list of names, as instances of ``sago_class``
+    spread over ``workers`` processes. ``sago_class`` and the keyword
+    arguments must be picklable; the class is created with ``loop``,
+    ``core`` and ``session_path`` set by the worker."""
+
+    RESTART_DELAY = 1
+    RESTART_MAX_DELAY = 60
+    # A worker that ran this long before dying starts over at RESTART_DELAY.
+    STABLE_AFTER = 60
+    STOP_TIMEOUT = 10
+
+    def __init__(self, sago_class, accounts, workers=None,
+                 session_dir='sessions', sago_kwargs=None, core_kwargs=None,
+                 start_method='spawn'):
+        self.sago_class = sago_class
+        self.session_dir = os.path.abspath(session_dir)
+        self.sago_kwargs = sago_kwargs or {}
+        self.core_kwargs = core_kwargs or {}
+        self.context = multiprocessing.get_context(start_method)
+
+        # One worker per account at most, so none is started empty.
+        workers = min(workers or os.cpu_count() or 1, len(accounts)) or 1
+        self.workers = [WorkerProcess(i, names) for i, names in
+                        enumerate(assign_shards(accounts, workers))]
+
+        self.statuses = {name: 'starting' for name in accounts}
+        self._worker_of = {name: w for w in self.workers
+                           for name in w.accounts}
+        self._requests = {}
+        self._request_ids = itertools.count()
+        self._stopping = False
+        self._loop = None
+
+    def worker_of(self, account):
+        try:
+            return self._worker_of[account]
+        except KeyError:
+            raise WorkerError('Unknown account %r.' % account) from None
+
+    async def start(self):
+        self._loop = asyncio.get_event_loop()
+        if not os.path.exists(self.session_dir):
+            os.makedirs(self.session_dir)
+        for worker in self.workers:
+            worker.backoff = Backoff(self.RESTART_DELAY,
+                                     self.RESTART_MAX_DELAY)
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        if self._stopping:
+            return
+
+        conn, child_conn = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=run_worker, name='sago-worker-%d' % worker.index,
+            args=(worker.index, worker.accounts, self.sago_class,
+                  self.sago_kwargs, self.core_kwargs, self.session_dir,
+                  child_conn),
+            daemon=True)
+        worker.process.start()
+        child_conn.close()
+        worker.conn = conn
+        worker.sender = PipeSender(conn)
+        worker.started_at = time.monotonic()
+
+        self._loop.add_reader(conn.fileno(), self._on_data, worker)
+        self._loop.add_reader(worker.process.sentinel, self._on_exit, worker)
+        logger.info('Worker %d (pid %d) started with %d accounts.',
+                    worker.index, worker.process.pid, len(worker.accounts))
+
+    def _on_data(self, worker):
+        conn = worker.conn
+        while conn.poll():
+            try:
+                data = conn.recv()
+            except (EOFError, OSError):
+                self._loop.remove_reader(conn.fileno())
+                return
+
+            kind = data[0]
+            if kind == 'messages':
+                for name, packed in data[1]:
+                    try:
+                        self.message_received(name, unpack_message(packed))
+                    except Exception:
+                        logger.exception('Handling a message of %s failed.',
+                                         name)
+            elif kind == 'status':
+                _, name, status = data
+                self.statuses[name] = status
+                self.account_status_changed(name, status)
+            elif kind == 'result':
+                _, request_id, ok, value = data
+                _, future = self._requests.pop(request_id, (None, None))
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(WorkerError(value))
+
+    def _on_exit(self, worker):
+        process = worker.process
+        self._loop.remove_reader(process.sentinel)
+        try:
+            self._loop.remove_reader(worker.conn.fileno())
+        except (OSError, ValueError):
+            pass
+        # Deliver whatever the worker wrote before it died.
+        self._on_data(worker)
+        process.join()
+        worker.sender.close()
+        worker.conn.close()
+
+        for request_id, (index, future) in list(self._requests.items()):
+            if index == worker.index:
+                del self._requests[request_id]
+                if not future.done():
+                    future.set_exception(WorkerError(
+                        'Worker %d exited.' % worker.index))
+
+        if self._stopping:
+            return
+
+        for name in worker.accounts:
+            self.statuses[name] = 'restarting'
+        worker.restarts += 1
+        if time.monotonic() - worker.started_at > self.STABLE_AFTER:
+            worker.backoff.reset()
+        delay = worker.backoff.next_delay()
+        self.worker_exited(worker, process.exitcode)
+        logger.warning('Worker %d exited with %s, restarting in %.1fs.',
+                       worker.index, process.exitcode, delay)
+        self._loop.call_later(delay, self._spawn, worker)
+
+    def _request(self, worker, *command):
+        if worker.process is None or not worker.process.is_alive():
+            raise WorkerError('Worker %d is not running.' % worker.index)
+
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._requests[request_id] = (worker.index, future)
+        worker.sender.send((command[0], request_id) + command[1:])
+        return future
+
+    async def send_text(self, account, to_user, text):
+        to_user = getattr(to_user, 'uid', to_user)
+        return await self._request(
+            self.worker_of(account), 'send', account, to_user, text)
+
+    async def stats(self):
+        """Stats of every account, per worker and summed over the fleet."""
+        results = await asyncio.gather(
+            *[self._request(w, 'stats') for w in self.workers
+              if w.process is not None and w.process.is_alive()],
+            return_exceptions=True)
+
+        workers, accounts = {}, {}
+        for ret in results:
+            if isinstance(ret, Exception):
+                continue
+            accounts.update(ret['accounts'])
+            workers[ret['pid']] = sorted(ret['accounts'])
+
+        total = collections.Counter()
+        for stats in accounts.values():
+            total['accounts'] += 1
+            total['logged_in'] += stats['logged_in']
+            total['contacts'] += stats['contacts']
+            for key in ('syncs', 'messages', 'errors'):
+                total['sync_' + key] += stats['sync'][key]
+            for key, value in stats['dispatcher'].items():
+                total['dispatcher_' + key] += value
+            for key, value in stats['sender'].items():
+                total['sender_' + key] += value
+
+        return {
+            'total': dict(total),
+            'workers': workers,
+            'restarts': {w.index: w.restarts for w in self.workers},
+            'statuses': dict(self.statuses),
+            'accounts': accounts,
+        }
+
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            process = worker.process
+            if process is None or not process.is_alive():
+                continue
+            worker.sender.send(('stop',))
+
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for worker in self.workers:
+            process = worker.process
+            if process is None:
+                continue
+            timeout = max(0, deadline - time.monotonic())
+            await self._loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning('Worker %d did not stop, terminating it.',
+                               worker.index)
+                process.terminate()
+
+    async def run_forever(self):
+        await self.start()
+        stopped = self._loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(sig, stopped.set_result, None)
+        try:
+            await stopped
+        finally:
+            await self.stop()
+
+    def message_received(self, account, message):
+        return
+
+    def account_status_changed(self, account, status):
+        logger.info('Account %s is %s.', account, status)
+
+    def worker_exited(self, worker, exitcode):
+        return
+
+
+def load_class(path):
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name or 'BaseSago')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sago_class', help='module:Class of the bot')
+    parser.add_argument('accounts', nargs='+')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--session-dir', default='sessions')
+    parser.add_argument('--lazy-contacts', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    supervisor = Supervisor(
+        load_class(args.sago_class), args.accounts, args.workers,
+        args.session_dir, {'lazy_contacts': args.lazy_contacts})
+    asyncio.run(supervisor.run_forever())
+
+
+if __name__ == '__main__':
+    main()
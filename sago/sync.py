@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+
+RETCODE_OK = '0'
+
+# synccheck retcodes after which the session cannot be used any more.
+LOGOUT_RETCODES = {
+    '1100': 'logged out from the phone',
+    '1101': 'logged in on another device',
+    '1102': 'session invalidated',
+}
+
+SELECTOR_NONE = '0'
+
+# Every non-zero selector means webwxsync has something for us; the names are
+# only used for logging.
+SELECTORS = {
+    '2': 'new message',
+    '3': 'profile changed',
+    '4': 'contacts changed',
+    '6': 'new message and contacts changed',
+    '7': 'phone entered or left a chat',
+}
+
+
+class Backoff:
+
+    def __init__(self, base=1, maximum=60, jitter=0.5):
+        self.base = base
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class SyncStats:
+
+    def __init__(self):
+        self.polls = 0
+        self.empty_polls = 0
+        self.syncs = 0
+        self.messages = 0
+        self.errors = 0
+        self.last_sync_at = None
+        self.last_message_at = None
+        self.selectors = {}
+
+    @property
+    def lag(self):
+        """Seconds between the newest message's CreateTime and when we
+        received it on the last sync that carried messages."""
+        if self.last_message_at is None:
+            return
+        return self.last_sync_at - self.last_message_at
+
+    def record_poll(self, selector):
+        self.polls += 1
+        if selector == SELECTOR_NONE:
+            self.empty_polls += 1
+        else:
+            self.selectors[selector] = self.selectors.get(selector, 0) + 1
+
+    def record_sync(self, sync_data):
+        self.syncs += 1
+        self.last_sync_at = time.time()
+
+        messages = sync_data.get('AddMsgList') or ()
+        if messages:
+            self.messages += len(messages)
+            self.last_message_at = max(
+                m.get('CreateTime', 0) for m in messages)
+
+    def as_dict(self):
+        return {
+            'polls': self.polls,
+            'empty_polls': self.empty_polls,
+            'syncs': self.syncs,
+            'messages': self.messages,
+            'errors': self.errors,
+            'lag': self.lag,
+            'selectors': dict(self.selectors),
+        }
+
+    def __repr__(self):
+        return '<SyncStats polls: %d syncs: %d messages: %d errors: %d>' % (
+            self.polls, self.syncs, self.messages, self.errors)
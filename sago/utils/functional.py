@@ -32,6 +32,10 @@ class AsyncObject:
         return repr(self.c_func)
 
 
+def chunked(seq, size):
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+
 def random_str(length=10):
     return ''.join([random.choice(string.ascii_letters + string.digits)
                     for _ in range(length)])